@@ -23,6 +23,7 @@ class Service:
         for qt in QTYPES:
             ret_val[str(qt[0])] = qt[1]
         return ret_val
+    get_type_mapping.concurrent_safe = True
 
     def get_type_options(self, opt):
         question_type = None
@@ -34,6 +35,7 @@ class Service:
             return question_type.create_choice_widget()
         else:
             raise Exception('Invalid Question Type')
+    get_type_options.concurrent_safe = True
     def save_question(self, question, qtype, data_hash):
         q = Question(question=question, question_type=int(qtype))
         q.save()
@@ -60,5 +62,6 @@ class Service:
         ret_val['question'] = q.question
         ret_val['qid'] = q.id
         return ret_val
+    get_question.concurrent_safe = True
 
 service = Service()
@@ -0,0 +1,14 @@
+from django.core.cache import cache
+from photologue.models import upload_progress_key
+
+class Service:
+    def upload_progress(self, progress_id):
+        """
+        Returns the progress of the photologue zip upload posted with the given
+        X-Progress-ID, as a hash of total, processed and added image counts plus
+        a done flag
+        """
+        return cache.get(upload_progress_key(progress_id))
+    upload_progress.concurrent_safe = True
+
+service = Service()
@@ -11,6 +11,15 @@ class GalleryAdmin(admin.ModelAdmin):
     prepopulated_fields = {'title_slug': ('title',)}
     filter_horizontal = ('photos',)
 
+    def save_model(self, request, obj, form, change):
+        obj.save()
+        # the photos are saved after this returns, clear the cached photo list then
+        save_m2m = form.save_m2m
+        def save_m2m_and_clear():
+            save_m2m()
+            Gallery.objects.clear_photo_lists([obj.pk])
+        form.save_m2m = save_m2m_and_clear
+
 class PhotoAdmin(admin.ModelAdmin):
     list_display = ('title', 'date_taken', 'date_added', 'is_public', 'tags', 'view_count', 'admin_thumbnail')
     list_filter = ['date_added', 'is_public']
@@ -54,10 +63,17 @@ class PhotoSizeAdmin(admin.ModelAdmin):
 class WatermarkAdmin(admin.ModelAdmin):
     list_display = ('name', 'opacity', 'style')
 
+class GalleryUploadAdmin(admin.ModelAdmin):
+    def save_model(self, request, obj, form, change):
+        # the upload form posts to ?X-Progress-ID=<id> and polls
+        # upload_progress with the same id while the archive is processed
+        obj.progress_id = request.GET.get('X-Progress-ID')
+        obj.save()
+
 
 admin.site.register(Gallery, GalleryAdmin)
-admin.site.register(GalleryUpload)
+admin.site.register(GalleryUpload, GalleryUploadAdmin)
 admin.site.register(Photo, PhotoAdmin)
 admin.site.register(PhotoEffect, PhotoEffectAdmin)
 admin.site.register(PhotoSize, PhotoSizeAdmin)
-admin.site.register(Watermark, WatermarkAdmin)
\ No newline at end of file
+admin.site.register(Watermark, WatermarkAdmin)
\ No newline at end of file
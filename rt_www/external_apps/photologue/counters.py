@@ -0,0 +1,116 @@
+""" Buffered view counts for Photologue photos.
+
+Increments are collected per photo in the current process and written out
+as one "view_count = view_count + n" UPDATE per photo, instead of saving
+the whole row on every view. A timer writes them out at most
+PHOTOLOGUE_VIEW_COUNT_INTERVAL seconds after they were counted, so an idle
+process does not hold on to them; a process that is killed loses at most
+that many seconds of views.
+
+plflushcounts reaches other processes through the cache, which needs a
+backend shared by every process (see CACHE_BACKEND in the settings).
+
+"""
+import atexit
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+from django.db.models import F
+
+# Number of seconds increments are buffered for before being written to the
+# database. Set to 0 to write every increment immediately.
+PHOTOLOGUE_VIEW_COUNT_INTERVAL = getattr(settings, 'PHOTOLOGUE_VIEW_COUNT_INTERVAL', 60)
+
+# Number of seconds between looks at the flush request left by plflushcounts,
+# so that views don't cost a cache round-trip each.
+PHOTOLOGUE_VIEW_COUNT_CHECK_INTERVAL = getattr(settings, 'PHOTOLOGUE_VIEW_COUNT_CHECK_INTERVAL', 10)
+
+# Cache key used by the plflushcounts command to ask every process to flush.
+FLUSH_REQUEST_KEY = 'photologue_view_count_flush'
+
+
+def request_flush():
+    """ Asks every process sharing the cache backend to flush the next time
+    it checks. """
+    cache.set(FLUSH_REQUEST_KEY, time.time())
+
+
+class ViewCounter(object):
+    """ Process-wide buffer of pending view count increments.
+
+    Shares its state between instances in the same way as PhotoSizeCache.
+    """
+    __state = {'counts': {}, 'lock': threading.Lock(), 'last_flush': time.time(),
+               'last_check': time.time(), 'timer': None}
+
+    def __init__(self):
+        self.__dict__ = self.__state
+
+    def _key(self, obj):
+        return (obj.__class__, obj._get_pk_val())
+
+    def increment(self, obj, n=1):
+        self.lock.acquire()
+        try:
+            key = self._key(obj)
+            self.counts[key] = self.counts.get(key, 0) + n
+            if self.timer is None and PHOTOLOGUE_VIEW_COUNT_INTERVAL > 0:
+                self.timer = threading.Timer(PHOTOLOGUE_VIEW_COUNT_INTERVAL, self._timed_flush)
+                self.timer.setDaemon(True)
+                self.timer.start()
+        finally:
+            self.lock.release()
+        now = time.time()
+        if now - self.last_flush >= PHOTOLOGUE_VIEW_COUNT_INTERVAL:
+            self.flush()
+        elif now - self.last_check >= PHOTOLOGUE_VIEW_COUNT_CHECK_INTERVAL:
+            self.last_check = now
+            if cache.get(FLUSH_REQUEST_KEY, 0) > self.last_flush:
+                self.flush()
+
+    def _timed_flush(self):
+        self.lock.acquire()
+        try:
+            self.timer = None
+        finally:
+            self.lock.release()
+        try:
+            self.flush()
+        finally:
+            # the timer thread has a database connection of its own
+            connection.close()
+
+    def discard(self, obj, n=None):
+        """ Drops up to n buffered increments for obj, or all of them. """
+        self.lock.acquire()
+        try:
+            key = self._key(obj)
+            count = self.counts.pop(key, 0)
+            if n is not None and count > n:
+                self.counts[key] = count - n
+        finally:
+            self.lock.release()
+
+    def flush(self):
+        self.lock.acquire()
+        try:
+            counts = self.counts
+            self.counts = {}
+            self.last_flush = time.time()
+        finally:
+            self.lock.release()
+        for (model, pk), n in counts.items():
+            if n > 0:
+                model._default_manager.filter(pk=pk).update(view_count=F('view_count') + n)
+
+
+def flush_on_exit():
+    try:
+        ViewCounter().flush()
+    except Exception:
+        pass
+
+atexit.register(flush_on_exit)
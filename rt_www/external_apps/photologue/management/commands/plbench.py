@@ -0,0 +1,253 @@
+import os
+import tempfile
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models.signals import post_init
+from django.utils.functional import curry
+from optparse import make_option
+from time import time
+from photologue.models import ImageModel, Photo, PhotoEffect, PhotoSizeCache, Watermark, SAMPLE_IMAGE_PATH
+from photologue.models import Image, ImageEnhance, ImageFilter
+from photologue.utils import EXIF
+from photologue.utils.cache import LayerCache
+from photologue.utils.watermark import reduce_opacity, prepare_layer, apply_layer
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--repeat', '-n', type='int', dest='repeat', default=5, help='Number of timed runs, the best one is reported'),
+        make_option('--limit', '-l', type='int', dest='limit', default=500, help='Number of photos to load per run'),
+        make_option('--path', '-p', dest='path', help='Folder of sample images to use instead of the photo originals'),
+    )
+
+    help = ('Runs Photologue micro-benchmarks.')
+    args = '[benchmarks]'
+
+    requires_model_validation = True
+    can_import_settings = True
+
+    def handle(self, *args, **options):
+        return run_benchmarks(args, options)
+
+def best_of(repeat, func):
+    times = []
+    for i in range(repeat):
+        start = time()
+        func()
+        times.append(time() - start)
+    return min(times)
+
+def bind_accessors(sender, instance, **kwargs):
+    """
+    The per-instance accessor binding photologue used before the accessors
+    were resolved by ImageModel.__getattr__
+    """
+    if isinstance(instance, ImageModel):
+        for size in PhotoSizeCache().sizes.keys():
+            for kind in ('size', 'photosize', 'url', 'filename'):
+                setattr(instance, 'get_%s_%s' % (size, kind),
+                        curry(getattr(instance, '_get_SIZE_%s' % kind), size=size))
+
+def bench_accessors(options):
+    """
+    Queryset materialisation time with lazy accessors and with post_init binding
+    """
+    repeat, limit = options.get('repeat'), options.get('limit')
+    print '%d photo sizes defined' % len(PhotoSizeCache().sizes)
+    for cls in ImageModel.__subclasses__():
+        def load():
+            list(cls.objects.all()[:limit])
+        count = cls.objects.all()[:limit].count()
+        lazy = best_of(repeat, load)
+        post_init.connect(bind_accessors)
+        try:
+            bound = best_of(repeat, load)
+        finally:
+            post_init.disconnect(bind_accessors)
+        print '%s: %d objects, post_init binding %.4fs, lazy accessors %.4fs' % \
+            (cls.__name__, count, bound, lazy)
+
+class CountingFile(object):
+    """
+    File wrapper counting the seek and read calls made through it
+    """
+    def __init__(self, f):
+        self.f = f
+        self.calls = 0
+
+    def read(self, *args):
+        self.calls += 1
+        return self.f.read(*args)
+
+    def seek(self, *args):
+        self.calls += 1
+        return self.f.seek(*args)
+
+    def __getattr__(self, name):
+        return getattr(self.f, name)
+
+def sample_images(options):
+    """
+    Paths of the images in --path, or of up to --limit photo originals
+    """
+    limit, path = options.get('limit'), options.get('path')
+    if path:
+        return [os.path.join(path, name) for name in sorted(os.listdir(path))
+                if os.path.splitext(name)[1].lower() in ('.jpg', '.jpeg', '.tif', '.tiff')][:limit]
+    paths = []
+    for cls in ImageModel.__subclasses__():
+        paths.extend([obj.image.path for obj in cls.objects.all()[:limit - len(paths)]])
+    return paths
+
+def bench_exif(options):
+    """
+    EXIF tag extraction with the buffered reader and with per-value file reads
+    """
+    repeat, paths = options.get('repeat'), sample_images(options)
+    if not paths:
+        raise CommandError('No sample images were found.')
+    for buffered in (False, True):
+        stats = {}
+        def extract():
+            stats['tags'] = stats['calls'] = 0
+            for path in paths:
+                f = CountingFile(open(path, 'rb'))
+                try:
+                    stats['tags'] += len(EXIF.process_file(f, details=False, buffered=buffered))
+                finally:
+                    f.close()
+                stats['calls'] += f.calls
+        elapsed = max(best_of(repeat, extract), 0.000001)
+        print '%s: %d images, %d tags, %.0f tags/s, %d file reads and seeks' % \
+            (buffered and 'buffered' or 'per-value reads', len(paths), stats['tags'],
+             stats['tags'] / elapsed, stats['calls'])
+
+def legacy_apply_watermark(im, mark, position, opacity=1):
+    """
+    Watermarking as photologue did it before prepared layers were cached
+    """
+    if opacity < 1:
+        mark = reduce_opacity(mark, opacity)
+    if im.mode != 'RGBA':
+        im = im.convert('RGBA')
+    layer = Image.new('RGBA', im.size, (0,0,0,0))
+    if position == 'tile':
+        for y in range(0, im.size[1], mark.size[1]):
+            for x in range(0, im.size[0], mark.size[0]):
+                layer.paste(mark, (x, y))
+    else:
+        ratio = min(
+            float(im.size[0]) / mark.size[0], float(im.size[1]) / mark.size[1])
+        w = int(mark.size[0] * ratio)
+        h = int(mark.size[1] * ratio)
+        mark = mark.resize((w, h))
+        layer.paste(mark, ((im.size[0] - w) / 2, (im.size[1] - h) / 2))
+    return Image.composite(layer, im, layer)
+
+def bench_watermark(options):
+    """
+    Watermarking every photo size in tile and scale style, opening and
+    preparing the mark on every render and with cached prepared layers
+    """
+    repeat, limit = options.get('repeat'), options.get('limit')
+    renders = limit / 10 or 1
+    sample = Image.open(SAMPLE_IMAGE_PATH)
+    sample.load()
+    watermarks = list(Watermark.objects.all()[:1])
+    if watermarks:
+        mark_path = watermarks[0].image.path
+    else:
+        # a small mark, so that tiling covers a photo with many cells
+        fd, mark_path = tempfile.mkstemp('.png')
+        os.close(fd)
+        sample.resize((32, 24)).save(mark_path)
+    sizes = [size for size in PhotoSizeCache().sizes.values() if size.width and size.height]
+    if not sizes:
+        raise CommandError('No photo sizes with both a width and a height were found.')
+    try:
+        for style in ('tile', 'scale'):
+            for size in sorted(sizes, key=lambda size: size.size):
+                im = sample.resize(size.size)
+                layers = LayerCache()
+                def legacy():
+                    for i in range(renders):
+                        legacy_apply_watermark(im, Image.open(mark_path), style, 0.5)
+                def cached():
+                    for i in range(renders):
+                        layer = layers.get((mark_path, im.size, style, 0.5),
+                                           lambda: prepare_layer(Image.open(mark_path), im.size, style, 0.5))
+                        apply_layer(im, layer)
+                old, new = best_of(repeat, legacy), best_of(repeat, cached)
+                print '%s %s %dx%d, %d renders: legacy %.4fs, cached layers %.4fs' % \
+                    (style, size.name, im.size[0], im.size[1], renders, old, new)
+    finally:
+        if not watermarks:
+            os.remove(mark_path)
+
+def legacy_pre_process(effect, im):
+    """
+    PhotoEffect.pre_process as it was before the enhancements were fused
+    """
+    if effect.transpose_method != '':
+        im = im.transpose(getattr(Image, effect.transpose_method))
+    if im.mode != 'RGB' and im.mode != 'RGBA':
+        return im
+    for name in ['Color', 'Brightness', 'Contrast', 'Sharpness']:
+        factor = getattr(effect, name.lower())
+        if factor != 1.0:
+            im = getattr(ImageEnhance, name)(im).enhance(factor)
+    for name in effect.filters.split('->'):
+        image_filter = getattr(ImageFilter, name.upper(), None)
+        if image_filter is not None:
+            try:
+                im = im.filter(image_filter)
+            except ValueError:
+                pass
+    return im
+
+def bench_effects(options):
+    """
+    Rendering every photo size through each photo effect, with the separate
+    enhancement passes and with the fused, deferred plan
+    """
+    repeat, limit = options.get('repeat'), options.get('limit')
+    renders = limit / 10 or 1
+    sample = Image.open(SAMPLE_IMAGE_PATH)
+    sample.load()
+    effects = list(PhotoEffect.objects.all())
+    if not effects:
+        effects = [PhotoEffect(name='enhance', color=0.5, brightness=1.1, contrast=1.2),
+                   PhotoEffect(name='sharpen', color=0.5, brightness=1.1, sharpness=2.0),
+                   PhotoEffect(name='filters', color=0.5, filters='BLUR->DETAIL')]
+    sizes = [size for size in PhotoSizeCache().sizes.values() if size.width and size.height]
+    if not sizes:
+        raise CommandError('No photo sizes with both a width and a height were found.')
+    photo = Photo()
+    for effect in effects:
+        for size in sorted(sizes, key=lambda size: size.size):
+            def legacy():
+                for i in range(renders):
+                    photo.resize_image(legacy_pre_process(effect, sample), size)
+            def fused():
+                for i in range(renders):
+                    effect.resized_process(photo.resize_image(effect.pre_process(sample), size))
+            old, new = best_of(repeat, legacy), best_of(repeat, fused)
+            print '%s %s, %d renders: separate passes %.4fs, fused %.4fs' % \
+                (effect.name, size.name, renders, old, new)
+
+BENCHMARKS = {
+    'accessors': bench_accessors,
+    'effects': bench_effects,
+    'exif': bench_exif,
+    'watermark': bench_watermark,
+}
+
+def run_benchmarks(names, options):
+    """
+    Runs the given benchmarks, or all of them
+    """
+    if not names:
+        names = sorted(BENCHMARKS.keys())
+    for name in names:
+        if name not in BENCHMARKS:
+            raise CommandError('Unknown benchmark "%s". Choose from: %s' % (name, ', '.join(sorted(BENCHMARKS.keys()))))
+        print '== %s ==' % name
+        BENCHMARKS[name](options)
@@ -1,10 +1,25 @@
+import os
+from datetime import datetime
+from itertools import imap
+from time import time
+
+from django.conf import settings
 from django.core.management.base import BaseCommand, CommandError
+from django.db.models import get_model
 from optparse import make_option
-from photologue.models import PhotoSize, ImageModel
+from photologue.models import PhotoSize, ImageModel, PHOTOLOGUE_DIR
+from photologue import rendering
+
+CHECKPOINT_PATH = os.path.join(settings.MEDIA_ROOT, PHOTOLOGUE_DIR, 'plcache.checkpoint')
 
 class Command(BaseCommand):
     option_list = BaseCommand.option_list + (
         make_option('--reset', '-r', action='store_true', dest='reset', help='Reset photo cache before generating'),
+        make_option('--workers', '-w', type='int', dest='workers', default=1, help='Number of worker processes'),
+        make_option('--since', '-s', dest='since', help='Only cache photos taken on or after this date (YYYY-MM-DD)'),
+        make_option('--gallery', '-g', dest='gallery', help='Only cache photos in the gallery with this slug'),
+        make_option('--resume', action='store_true', dest='resume', help='Continue from where the last interrupted run stopped'),
+        make_option('--chunk', '-c', type='int', dest='chunk', default=100, help='Number of photos handed to a worker at a time'),
     )
 
     help = ('Manages Photologue cache file for the given sizes.')
@@ -16,11 +31,70 @@ class Command(BaseCommand):
     def handle(self, *args, **options):
         return create_cache(args, options)
 
+def read_checkpoint(signature):
+    """
+    Returns the last cached primary key of each model, if the checkpoint was
+    written by a run with the same arguments
+    """
+    try:
+        lines = open(CHECKPOINT_PATH).read().splitlines()
+    except IOError:
+        return {}
+    if not lines or lines[0] != signature:
+        return {}
+    checkpoint = {}
+    for line in lines[1:]:
+        model, pk = line.split()
+        checkpoint[model] = int(pk)
+    return checkpoint
+
+def write_checkpoint(signature, checkpoint):
+    if not os.path.isdir(os.path.dirname(CHECKPOINT_PATH)):
+        os.makedirs(os.path.dirname(CHECKPOINT_PATH))
+    f = open(CHECKPOINT_PATH + '.tmp', 'w')
+    f.write('\n'.join([signature] + ['%s %s' % item for item in checkpoint.items()]))
+    f.close()
+    os.rename(CHECKPOINT_PATH + '.tmp', CHECKPOINT_PATH)
+
+def chunked(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def cache_chunk(job):
+    """
+    Caches the given sizes for one chunk of photos, returns the last primary
+    key of the chunk, the number of photos and the number of bytes written
+    """
+    app_label, model_name, pks, size_names, reset = job
+    model = get_model(app_label, model_name)
+    sizes = list(PhotoSize.objects.filter(name__in=size_names))
+    written = 0
+    for obj in model._default_manager.filter(pk__in=pks).iterator():
+        if reset:
+            for photosize in sizes:
+                obj.remove_size(photosize, False, keep_shared=False)
+        existing = obj._get_size_index().keys()
+        obj.create_sizes(sizes)
+        for name, entry in obj._get_size_index().items():
+            if name not in existing:
+                written += entry.filesize
+    return pks[-1], len(pks), written
+
 def create_cache(sizes, options):
     """
     Creates the cache for the given files
     """
     reset = options.get('reset', None)
+    workers = options.get('workers') or 1
+    chunk = options.get('chunk') or 100
+    gallery = options.get('gallery', None)
+    since = options.get('since', None)
 
     size_list = [size.strip(' ,') for size in sizes]
 
@@ -32,12 +106,59 @@ def create_cache(sizes, options):
     if not len(sizes):
         raise CommandError('No photo sizes were found.')
 
-    print 'Caching photos, this may take a while...'
+    if since is not None:
+        try:
+            since = datetime.strptime(since, '%Y-%m-%d')
+        except ValueError:
+            raise CommandError('--since must be a date formatted as YYYY-MM-DD.')
+
+    size_names = [size.name for size in sizes]
+    signature = ' '.join([','.join(sorted(size_names)), str(reset), str(since), str(gallery)])
+    checkpoint = {}
+    if options.get('resume', None):
+        checkpoint = read_checkpoint(signature)
+
+    print 'Caching %s size images, this may take a while...' % ', '.join(size_names)
+
+    if workers > 1:
+        pool = rendering.pool(workers)
+        run = pool.imap
+    else:
+        pool = None
+        run = imap
+
+    start, photos, written = time(), 0, 0
+    try:
+        for cls in ImageModel.__subclasses__():
+            queryset = cls.objects.all()
+            if gallery is not None:
+                if not hasattr(cls, 'galleries'):
+                    continue
+                queryset = queryset.filter(galleries__title_slug=gallery)
+            if since is not None:
+                queryset = queryset.filter(date_taken__gte=since)
+            label = '%s.%s' % (cls._meta.app_label, cls._meta.object_name)
+            if label in checkpoint:
+                queryset = queryset.filter(pk__gt=checkpoint[label])
+            # only the primary keys are held in memory, the photos themselves
+            # are loaded chunk by chunk by the workers
+            pks = queryset.order_by('pk').values_list('pk', flat=True).iterator()
+            jobs = [(cls._meta.app_label, cls._meta.object_name, pk_chunk, size_names, reset)
+                    for pk_chunk in chunked(pks, chunk)]
+            for last_pk, count, nbytes in run(cache_chunk, jobs):
+                photos += count
+                written += nbytes
+                checkpoint[label] = last_pk
+                write_checkpoint(signature, checkpoint)
+                print '%s: cached up to #%s (%d photos so far)' % (label, last_pk, photos)
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+    # the run completed, the next one starts from scratch
+    if os.path.isfile(CHECKPOINT_PATH):
+        os.remove(CHECKPOINT_PATH)
 
-    for cls in ImageModel.__subclasses__():
-        for photosize in sizes:
-            print 'Cacheing %s size images' % photosize.name
-            for obj in cls.objects.all():
-                if reset:
-                    obj.remove_size(photosize)
-                obj.create_size(photosize)
+    elapsed = max(time() - start, 0.001)
+    print 'Cached %d photos in %.1fs (%.1f photos/s), %.1f MB written' % \
+        (photos, elapsed, photos / elapsed, written / 1048576.0)
@@ -0,0 +1,105 @@
+from itertools import imap
+from time import time
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import get_model
+from optparse import make_option
+from photologue.models import ImageModel, PhotoMetadata
+from photologue import rendering
+from photologue.management.commands.plcache import chunked
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--workers', '-w', type='int', dest='workers', default=1, help='Number of worker processes'),
+        make_option('--chunk', '-c', type='int', dest='chunk', default=100, help='Number of photos handed to a worker at a time'),
+        make_option('--force', '-f', action='store_true', dest='force', help='Read every photo, even if its file has not changed'),
+        make_option('--update-dates', action='store_true', dest='update_dates', help='Set the date taken of photos to their EXIF date'),
+    )
+
+    help = ('Reads the EXIF metadata of every photo into the PhotoMetadata table.')
+
+    requires_model_validation = True
+    can_import_settings = True
+
+    def handle(self, *args, **options):
+        return extract_metadata(options)
+
+def read_chunk(job):
+    """
+    Reads the EXIF tags of the photos of one chunk whose file changed. Runs in
+    a worker, which only reads from the database; returns the chunk with the
+    tags keyed by photo id for the parent to save
+    """
+    app_label, model_name, pks, force = job
+    model = get_model(app_label, model_name)
+    content_type = ContentType.objects.get_for_model(model)
+    existing = dict([(metadata.object_id, metadata) for metadata in
+                     PhotoMetadata.objects.filter(content_type=content_type, object_id__in=pks)])
+    tags = {}
+    for obj in model._default_manager.filter(pk__in=pks).iterator():
+        metadata = existing.get(obj.pk)
+        if force or metadata is None or not metadata.is_current(obj.image.name, obj.image.path):
+            tags[obj.pk] = obj._read_exif()
+    return app_label, model_name, pks, tags
+
+def save_chunk(app_label, model_name, pks, tags, update_dates):
+    """
+    Stores the tags read for one chunk of photos, returns the number of dates
+    updated
+    """
+    model = get_model(app_label, model_name)
+    existing = {}
+    if update_dates:
+        content_type = ContentType.objects.get_for_model(model)
+        existing = dict([(metadata.object_id, metadata) for metadata in
+                         PhotoMetadata.objects.filter(content_type=content_type, object_id__in=pks)])
+    dated = 0
+    for obj in model._default_manager.filter(pk__in=pks).iterator():
+        if obj.pk in tags:
+            obj._store_metadata(tags[obj.pk])
+            existing[obj.pk] = obj._metadata
+        metadata = existing.get(obj.pk)
+        if update_dates and metadata is not None and metadata.date_taken is not None \
+                and metadata.date_taken != obj.date_taken:
+            model._default_manager.filter(pk=obj.pk).update(date_taken=metadata.date_taken)
+            dated += 1
+    return dated
+save_chunk = transaction.commit_on_success(save_chunk)
+
+def extract_metadata(options):
+    """
+    Reads the metadata of every photo whose file changed since the last run
+    """
+    workers = options.get('workers') or 1
+    chunk = options.get('chunk') or 100
+    force = options.get('force', False)
+    update_dates = options.get('update_dates', False)
+
+    if workers > 1:
+        pool = rendering.pool(workers)
+        run = pool.imap_unordered
+    else:
+        pool = None
+        run = imap
+
+    start, photos, read, dated = time(), 0, 0, 0
+    try:
+        for cls in ImageModel.__subclasses__():
+            pks = cls.objects.order_by('pk').values_list('pk', flat=True).iterator()
+            jobs = [(cls._meta.app_label, cls._meta.object_name, pk_chunk, force)
+                    for pk_chunk in chunked(pks, chunk)]
+            # workers only read, sqlite can't take writes from all of them
+            for app_label, model_name, pk_chunk, tags in run(read_chunk, jobs):
+                dated += save_chunk(app_label, model_name, pk_chunk, tags, update_dates)
+                photos += len(pk_chunk)
+                read += len(tags)
+            print '%s: %d photos checked so far' % (cls.__name__, photos)
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+    elapsed = max(time() - start, 0.001)
+    print 'Checked %d photos in %.1fs, read %d files (%.1f files/s), updated %d dates' % \
+        (photos, elapsed, read, read / elapsed, dated)
@@ -32,4 +32,4 @@ def create_cache(sizes, options):
         for photosize in sizes:
             print 'Flushing %s size images' % photosize.name
             for obj in cls.objects.all():
-                obj.remove_size(photosize)
+                obj.remove_size(photosize, keep_shared=False)
@@ -0,0 +1,20 @@
+from django.core.management.base import NoArgsCommand
+from photologue.counters import ViewCounter, request_flush
+
+class Command(NoArgsCommand):
+    help = ('Writes buffered Photologue view counts to the database.')
+
+    requires_model_validation = True
+    can_import_settings = True
+
+    def handle_noargs(self, **options):
+        return flush_counts()
+
+def flush_counts():
+    """
+    Flushes this process and asks running processes, which share the cache
+    backend, to flush within PHOTOLOGUE_VIEW_COUNT_CHECK_INTERVAL seconds of
+    their next view. Idle processes flush on their own timer.
+    """
+    request_flush()
+    ViewCounter().flush()
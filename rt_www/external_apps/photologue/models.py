@@ -1,18 +1,29 @@
 import os
 import random
+import re
 import shutil
+import tempfile
+import threading
+import time
+import warnings
 import zipfile
 
 from datetime import datetime
 from inspect import isclass
 
-from django.db import models
-from django.db.models.signals import post_init
+from django.db import models, transaction, connection, IntegrityError
+from django.db.models.signals import post_save, post_delete, pre_delete
 from django.conf import settings
-from django.core.files.base import ContentFile
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.core.files.base import File
+from django.core.files.storage import FileSystemStorage, default_storage
+from django.core.signals import request_started
 from django.core.urlresolvers import reverse
 from django.template.defaultfilters import slugify
+from django.utils import simplejson
 from django.utils.functional import curry
+from django.utils.hashcompat import sha_constructor
 from django.utils.translation import ugettext_lazy as _
 
 # Required PIL classes may or may not be available from the root namespace
@@ -48,11 +59,72 @@ except ImportError:
 
 from utils import EXIF
 from utils.reflection import add_reflection
-from utils.watermark import apply_watermark
+from utils.cache import LayerCache
+from utils.watermark import prepare_layer, apply_layer
+from rendering import RenderQueue
+from counters import ViewCounter
 
 # Path to sample image
 SAMPLE_IMAGE_PATH = getattr(settings, 'SAMPLE_IMAGE_PATH', os.path.join(os.path.dirname(__file__), 'res', 'sample.jpg')) # os.path.join(settings.PROJECT_PATH, 'photologue', 'res', 'sample.jpg'
 
+# Url served while a photo size is rendered in the background and no other
+# size of the photo is cached yet. Defaults to the original image.
+PHOTOLOGUE_PLACEHOLDER_URL = getattr(settings, 'PHOTOLOGUE_PLACEHOLDER_URL', None)
+
+# Cache key of the generation counter shared by every PhotoSizeCache
+PHOTOSIZE_GENERATION_KEY = getattr(settings, 'PHOTOLOGUE_PHOTOSIZE_GENERATION_KEY', 'photologue_photosize_generation')
+
+# Number of seconds a process outside of a request (the ftp server, management
+# commands, workers) goes without checking the generation counter
+PHOTOSIZE_CHECK_INTERVAL = getattr(settings, 'PHOTOLOGUE_PHOTOSIZE_CHECK_INTERVAL', 30)
+
+# The generation counter, view count flush requests, upload progress and
+# gallery photo lists are shared between processes through the cache. Only
+# warned about in production, development and tests run a single process.
+if not settings.DEBUG and \
+        getattr(settings, 'CACHE_BACKEND', 'locmem://').split(':')[0] in ('locmem', 'simple', 'dummy'):
+    warnings.warn('Photologue needs a cache backend shared by every process, such as memcached '
+                  'or the database cache. With a per-process CACHE_BACKEND, changes made in one '
+                  'process are not seen by the others.', RuntimeWarning)
+
+# Number of threads extracting and validating the images of a zip upload
+UPLOAD_WORKERS = getattr(settings, 'PHOTOLOGUE_UPLOAD_WORKERS', 4)
+
+# Number of seconds the progress of a zip upload is kept in the cache
+UPLOAD_PROGRESS_TIMEOUT = getattr(settings, 'PHOTOLOGUE_UPLOAD_PROGRESS_TIMEOUT', 3600)
+
+# EXIF tags stored for every photo. The original is only parsed until all
+# of them have been found.
+EXIF_TAGS = getattr(settings, 'PHOTOLOGUE_EXIF_TAGS', ('Make', 'Model', 'Orientation',
+                    'ExposureTime', 'FNumber', 'ISOSpeedRatings', 'DateTimeOriginal',
+                    'FocalLength', 'GPSLatitudeRef', 'GPSLatitude', 'GPSLongitudeRef',
+                    'GPSLongitude'))
+
+# Binary tags that are never stored
+EXIF_SKIPPED_TAGS = ('JPEGThumbnail', 'TIFFThumbnail', 'EXIF MakerNote')
+
+# Number of prepared watermark layers kept per process, one is needed for
+# every combination of watermark and photo size in use.
+WATERMARK_CACHE_SIZE = getattr(settings, 'PHOTOLOGUE_WATERMARK_CACHE_SIZE', 16)
+
+# Number of seconds the public photo list of a gallery is kept in the cache.
+# Changes made through the models and the admin clear it straight away, this
+# bounds how long a change made any other way can go unnoticed.
+GALLERY_PHOTOS_TIMEOUT = getattr(settings, 'PHOTOLOGUE_GALLERY_PHOTOS_TIMEOUT', 300)
+
+# Number of photos whose dropped sizes are looked up and removed at a time,
+# sqlite allows at most 999 parameters in a statement
+INVALIDATE_CHUNK_SIZE = getattr(settings, 'PHOTOLOGUE_INVALIDATE_CHUNK_SIZE', 500)
+
+# Cache key of the time a size was last dropped. Files rendered before it
+# are stale even if they are still on disk, waiting for a worker to remove
+# them, and must not be indexed again.
+SIZE_DROPPED_KEY = 'photologue_size_dropped_%s'
+
+# Number of seconds the time a size was dropped is kept, longer than the
+# background removal of its files can take
+SIZE_DROPPED_TIMEOUT = 86400
+
 # Modify image file buffer size.
 ImageFile.MAXBLOCK = getattr(settings, 'PHOTOLOGUE_MAXBLOCK', 256 * 2 ** 10)
 
@@ -73,6 +145,13 @@ else:
     def get_storage_path(instance, filename):
         return os.path.join(PHOTOLOGUE_DIR, 'photos', filename)
 
+# Store originals under the hash of their content, so the same image uploaded
+# more than once is kept, and its sizes rendered, only once.
+PHOTOLOGUE_DEDUPLICATE = getattr(settings, 'PHOTOLOGUE_DEDUPLICATE', True)
+
+# Matches the base names given to originals by ContentHashStorage
+HASHED_NAME_RE = re.compile(r'^[0-9a-f]{40}$')
+
 # Quality options for JPEG images
 JPEG_QUALITY_CHOICES = (
     (30, _('Very Low')),
@@ -106,6 +185,9 @@ WATERMARK_STYLE_CHOICES = (
     ('scale', _('Scale')),
 )
 
+# Matches the names of the per-size accessors of ImageModel
+SIZE_ACCESSOR_RE = re.compile(r'^get_(.+)_(size|photosize|url|filename)$')
+
 # Prepare a list of image filters
 filter_names = []
 for n in dir(ImageFilter):
@@ -116,6 +198,51 @@ for n in dir(ImageFilter):
 IMAGE_FILTERS_HELP_TEXT = _('Chain multiple filters using the following pattern "FILTER_ONE->FILTER_TWO->FILTER_THREE". Image filters will be applied in order. The following filters are available: %s.' % (', '.join(filter_names)))
 
 
+def photo_list_key(gallery_id, size):
+    # lists built before a photo size, effect or watermark changed are not used
+    return 'photologue_gallery_photos_%s_%s_%s' % (PhotoSizeCache().generation, gallery_id, size)
+
+
+class GalleryManager(models.Manager):
+    def photo_lists(self, gallery_ids, size):
+        """ Returns the url of size and the title of the public photos of
+        each gallery, keyed by gallery id.
+
+        The lists are read from the cache with a single get_many. Galleries
+        missing from it are loaded with one query, and cached once every one
+        of their photos has size rendered.
+        """
+        keys = dict([(photo_list_key(gallery_id, size), gallery_id) for gallery_id in gallery_ids])
+        lists = dict([(keys[key], value) for key, value in cache.get_many(keys.keys()).items()])
+        missing = [gallery_id for gallery_id in gallery_ids if gallery_id not in lists]
+        if not missing:
+            return lists
+        photosize = PhotoSizeCache().sizes.get(size)
+        field = self.model._meta.get_field('photos')
+        qn = connection.ops.quote_name
+        photos = list(Photo.objects.filter(is_public=True, galleries__in=missing).extra(
+            select={'list_gallery_id': '%s.%s' % (qn(field.m2m_db_table()), qn(field.m2m_column_name()))}))
+        CachedSize.objects.prefetch(photos)
+        built = dict([(gallery_id, []) for gallery_id in missing])
+        complete = set(missing)
+        for photo in photos:
+            if not photo.size_exists(photosize):
+                complete.discard(photo.list_gallery_id)
+            built[photo.list_gallery_id].append({'url': photo._get_url_for_size(photosize),
+                                                 'title': photo.title})
+        for gallery_id in complete:
+            cache.set(photo_list_key(gallery_id, size), built[gallery_id], GALLERY_PHOTOS_TIMEOUT)
+        lists.update(built)
+        return lists
+
+    def clear_photo_lists(self, gallery_ids):
+        """ Drops the cached photo lists of the given galleries. """
+        sizes = PhotoSizeCache().sizes.keys()
+        for gallery_id in gallery_ids:
+            for size in sizes:
+                cache.delete(photo_list_key(gallery_id, size))
+
+
 class Gallery(models.Model):
     date_added = models.DateTimeField(_('date published'), default=datetime.now)
     title = models.CharField(_('title'), max_length=100, unique=True)
@@ -128,6 +255,8 @@ class Gallery(models.Model):
                                     null=True, blank=True)
     tags = TagField(help_text=tagfield_help_text, verbose_name=_('tags'))
 
+    objects = GalleryManager()
+
     class Meta:
         ordering = ['-date_added']
         get_latest_by = 'date_added'
@@ -185,12 +314,20 @@ class GalleryUpload(models.Model):
         verbose_name = _('gallery upload')
         verbose_name_plural = _('gallery uploads')
 
+    # Id the progress of the upload is published under, see upload_progress_key
+    progress_id = None
+
     def save(self, *args, **kwargs):
         super(GalleryUpload, self).save(*args, **kwargs)
+        if not self.progress_id:
+            self.progress_id = self.pk
         gallery = self.process_zipfile()
         super(GalleryUpload, self).delete()
         return gallery
 
+    def progress_key(self):
+        return upload_progress_key(self.progress_id)
+
     def process_zipfile(self):
         if os.path.isfile(self.zip_file.path):
             # TODO: implement try-except here
@@ -198,7 +335,13 @@ class GalleryUpload(models.Model):
             bad_file = zip.testzip()
             if bad_file:
                 raise Exception('"%s" in the .zip archive is corrupt.' % bad_file)
-            count = 1
+            # do not process meta files or empty members
+            filenames = [info.filename for info in zip.infolist()
+                         if not info.filename.startswith('__') and info.file_size]
+            zip.close()
+            progress = {'title': self.title, 'total': len(filenames),
+                        'processed': 0, 'added': 0, 'done': False}
+            cache.set(self.progress_key(), progress, UPLOAD_PROGRESS_TIMEOUT)
             if self.gallery:
                 gallery = self.gallery
             else:
@@ -207,47 +350,138 @@ class GalleryUpload(models.Model):
                                                  description=self.description,
                                                  is_public=self.is_public,
                                                  tags=self.tags)
-            from cStringIO import StringIO
-            for filename in zip.namelist():
-                if filename.startswith('__'): # do not process meta files
-                    continue
-                data = zip.read(filename)
-                if len(data):
-                    try:
-                        # the following is taken from django.newforms.fields.ImageField:
-                        #  load() is the only method that can spot a truncated JPEG,
-                        #  but it cannot be called sanely after verify()
-                        trial_image = Image.open(StringIO(data))
-                        trial_image.load()
-                        # verify() is the only method that can spot a corrupt PNG,
-                        #  but it must be called immediately after the constructor
-                        trial_image = Image.open(StringIO(data))
-                        trial_image.verify()
-                    except Exception:
-                        # if a "bad" file is found we just skip it.
-                        continue
-                    while 1:
-                        title = ' '.join([self.title, str(count)])
-                        slug = slugify(title)
-                        try:
-                            p = Photo.objects.get(title_slug=slug)
-                        except Photo.DoesNotExist:
-                            photo = Photo(title=title,
-                                          title_slug=slug,
-                                          caption=self.caption,
-                                          is_public=self.is_public,
-                                          tags=self.tags)
-                            photo.image.save(filename, ContentFile(data))
-                            gallery.photos.add(photo)
-                            count = count + 1
-                            break
-                        count = count + 1
-            zip.close()
+            tempdir = tempfile.mkdtemp()
+            try:
+                from multiprocessing.pool import ThreadPool
+                pool = ThreadPool(UPLOAD_WORKERS)
+                try:
+                    extracted = []
+                    jobs = [(self.zip_file.path, filename, tempdir) for filename in filenames]
+                    for result in pool.imap(extract_image, jobs):
+                        progress['processed'] += 1
+                        if result is not None:
+                            extracted.append(result)
+                        cache.set(self.progress_key(), progress, UPLOAD_PROGRESS_TIMEOUT)
+                finally:
+                    pool.close()
+                    pool.join()
+                self._add_photos(gallery, extracted, progress)
+            finally:
+                shutil.rmtree(tempdir, True)
+            progress['done'] = True
+            cache.set(self.progress_key(), progress, UPLOAD_PROGRESS_TIMEOUT)
             return gallery
 
+    def _add_photos(self, gallery, extracted, progress):
+        """ Creates a photo for every extracted image in a single transaction. """
+        # collect the slugs already taken by this title with a single query
+        prefix = slugify(self.title)
+        taken = set(Photo.objects.filter(title_slug__startswith=prefix).values_list('title_slug', flat=True))
+        count = 1
+        photos = []
+        for filename, path in extracted:
+            while 1:
+                title = ' '.join([self.title, str(count)])
+                slug = slugify(title)
+                count = count + 1
+                if slug not in taken:
+                    break
+            taken.add(slug)
+            photo = Photo(title=title,
+                          title_slug=slug,
+                          caption=self.caption,
+                          is_public=self.is_public,
+                          tags=self.tags)
+            f = open(path, 'rb')
+            try:
+                photo.image.save(os.path.basename(filename), File(f))
+            finally:
+                f.close()
+            photos.append(photo)
+            progress['added'] += 1
+        if photos:
+            gallery.photos.add(*photos)
+            Gallery.objects.clear_photo_lists([gallery.pk])
+        return photos
+    _add_photos = transaction.commit_on_success(_add_photos)
+
+
+def upload_progress_key(progress_id):
+    """ The cache key of the progress of an upload. The id is chosen by the
+    client, so it is limited to characters that are safe in a cache key. """
+    return 'photologue_upload_%s' % re.sub(r'[^\w-]', '', str(progress_id))[:64]
+
+_zipfiles = threading.local()
+
+def extract_image(job):
+    """ Streams one member of a zip archive to a file in tempdir.
+
+    Returns the member name and the path of the extracted file, or None if
+    the member is not a valid image. Runs in a worker thread, each thread
+    reads the archive through its own ZipFile.
+    """
+    zip_path, filename, tempdir = job
+    zips = getattr(_zipfiles, 'zips', None)
+    if zips is None:
+        zips = _zipfiles.zips = {}
+    if zip_path not in zips:
+        zips[zip_path] = zipfile.ZipFile(zip_path)
+    fd, path = tempfile.mkstemp(suffix=os.path.splitext(filename)[1], dir=tempdir)
+    dest = os.fdopen(fd, 'wb')
+    source = zips[zip_path].open(filename)
+    try:
+        shutil.copyfileobj(source, dest)
+    finally:
+        source.close()
+        dest.close()
+    try:
+        # load() is the only method that can spot a truncated image,
+        # so the image is decoded once here instead of verified separately
+        Image.open(path).load()
+    except Exception:
+        # if a "bad" file is found we just skip it.
+        os.remove(path)
+        return None
+    return filename, path
+
+
+def image_references(name):
+    """ Returns the number of photos, of every ImageModel subclass, whose
+    original is the file name.
+    """
+    return sum([cls._default_manager.filter(image=name).count()
+                for cls in ImageModel.__subclasses__()])
+
+
+class ContentHashStorage(FileSystemStorage):
+    """ Stores photo originals under the SHA-1 of their content, in the
+    directory chosen by get_storage_path.
+
+    Saving an image that is already stored returns the existing file instead
+    of writing a copy, and a file is only deleted once no photo refers to it.
+    """
+    def _save(self, name, content):
+        digest = sha_constructor()
+        for chunk in content.chunks():
+            digest.update(chunk)
+        ext = os.path.splitext(name)[1].lower()
+        name = os.path.join(os.path.dirname(name), digest.hexdigest() + ext)
+        if self.exists(name):
+            return name
+        return super(ContentHashStorage, self)._save(name, content)
+
+    def delete(self, name):
+        if not image_references(name):
+            super(ContentHashStorage, self).delete(name)
+
+if PHOTOLOGUE_DEDUPLICATE:
+    image_storage = ContentHashStorage()
+else:
+    image_storage = default_storage
+
 
 class ImageModel(models.Model):
-    image = models.ImageField(_('image'), upload_to=get_storage_path)
+    image = models.ImageField(_('image'), upload_to=get_storage_path, storage=image_storage)
     date_taken = models.DateTimeField(_('date taken'), null=True, blank=True, editable=False)
     view_count = models.PositiveIntegerField(default=0, editable=False)
     crop_from = models.CharField(_('crop from'), blank=True, max_length=10, default='center', choices=CROP_ANCHOR_CHOICES)
@@ -258,13 +492,51 @@ class ImageModel(models.Model):
 
     @property
     def EXIF(self):
+        metadata = self._get_metadata()
+        if metadata is not None:
+            return metadata.get_tags()
+        return self._read_exif()
+
+    def _read_exif(self):
+        """ Reads the EXIF tags of the original, stopping as soon as every tag
+        in PHOTOLOGUE_EXIF_TAGS has been found. MakerNotes are skipped.
+        """
+        try:
+            f = open(self.image.path, 'rb')
+        except IOError:
+            return {}
         try:
-            return EXIF.process_file(open(self.image.path, 'rb'))
-        except:
             try:
-                return EXIF.process_file(open(self.image.path, 'rb'), details=False)
+                return EXIF.process_file(f, stop_tag=EXIF_TAGS, details=False)
             except:
                 return {}
+        finally:
+            f.close()
+
+    def _get_metadata(self):
+        """ Returns the stored PhotoMetadata of this photo, reading and storing
+        it first for photos saved before metadata was kept.
+        """
+        if not hasattr(self, '_metadata'):
+            if self._get_pk_val() is None:
+                return None
+            try:
+                self._metadata = PhotoMetadata.objects.get(content_type=ContentType.objects.get_for_model(self),
+                                                           object_id=self._get_pk_val())
+            except PhotoMetadata.DoesNotExist:
+                self._store_metadata(self._read_exif())
+        return self._metadata
+
+    def _store_metadata(self, tags):
+        content_type = ContentType.objects.get_for_model(self)
+        PhotoMetadata.objects.filter(content_type=content_type,
+                                     object_id=self._get_pk_val()).delete()
+        self._metadata = PhotoMetadata(content_type=content_type,
+                                       object_id=self._get_pk_val(),
+                                       image=self.image.name)
+        self._metadata.set_tags(tags)
+        self._metadata.set_file_stat(self.image.path)
+        self._metadata.save()
 
     def admin_thumbnail(self):
         func = getattr(self, 'get_admin_thumbnail_url', None)
@@ -292,8 +564,101 @@ class ImageModel(models.Model):
     def _get_filename_for_size(self, size):
         size = getattr(size, 'name', size)
         base, ext = os.path.splitext(self.image_filename())
+        if HASHED_NAME_RE.match(base):
+            # originals are shared, so are their sizes unless this photo
+            # renders differently
+            if self.effect_id is not None:
+                base = '%s_e%s' % (base, self.effect_id)
+            if self.crop_from not in ('', 'center'):
+                base = '%s_%s' % (base, self.crop_from)
         return ''.join([base, '_', size, ext])
 
+    def _get_duplicate_querysets(self):
+        """ Returns, for each ImageModel subclass, the other photos sharing
+        the cached files of this one.
+        """
+        if not self.image or not HASHED_NAME_RE.match(os.path.splitext(self.image_filename())[0]):
+            return []
+        querysets = []
+        for cls in ImageModel.__subclasses__():
+            # the same original rendered the same way, see _get_filename_for_size
+            photos = cls._default_manager.filter(image=self.image.name)
+            if self.effect_id is None:
+                photos = photos.filter(effect__isnull=True)
+            else:
+                photos = photos.filter(effect=self.effect_id)
+            if self.crop_from in ('', 'center'):
+                photos = photos.filter(crop_from__in=('', 'center'))
+            else:
+                photos = photos.filter(crop_from=self.crop_from)
+            if isinstance(self, cls) and self._get_pk_val() is not None:
+                photos = photos.exclude(pk=self._get_pk_val())
+            querysets.append(photos)
+        return querysets
+
+    def _get_duplicates(self, limit=None):
+        """ Returns the other photos sharing the cached files of this one,
+        no more than limit of them when given.
+        """
+        duplicates = []
+        for photos in self._get_duplicate_querysets():
+            if limit is not None:
+                photos = photos[:limit - len(duplicates)]
+            duplicates.extend(photos)
+            if limit is not None and len(duplicates) >= limit:
+                break
+        return duplicates
+
+    def _remove_size_files(self, names, keep_shared=True, since=None):
+        """ Deletes the cached files of the sizes named in names.
+
+        A file is kept while another photo sharing it still has its size
+        indexed, unless keep_shared is False, in which case the entries of
+        those photos go with it. Files written after the time since are
+        kept as well, they were rendered again in the meantime.
+        """
+        names = list(names)
+        shared = set()
+        for photos in self._get_duplicate_querysets():
+            entries = CachedSize.objects.filter(content_type=ContentType.objects.get_for_model(photos.model),
+                                                object_id__in=photos.values('pk'),
+                                                size__in=names)
+            if keep_shared:
+                shared.update(entries.values_list('size', flat=True))
+            else:
+                entries.delete()
+        for name in names:
+            filename = os.path.join(self.cache_path(), self._get_filename_for_size(name))
+            if name in shared or not os.path.isfile(filename):
+                continue
+            if since is None or os.path.getmtime(filename) <= since:
+                os.remove(filename)
+
+    def _adopt_sizes(self):
+        """ Indexes the sizes a duplicate of this photo already rendered,
+        so they aren't rendered again.
+        """
+        if self._get_pk_val() is None:
+            return
+        duplicates = self._get_duplicates(limit=1)
+        if not duplicates:
+            return
+        content_type = ContentType.objects.get_for_model(self)
+        index = self._get_size_index()
+        for name, entry in duplicates[0]._get_size_index().items():
+            if name in index or not os.path.isfile(os.path.join(self.cache_path(),
+                                                   self._get_filename_for_size(name))):
+                continue
+            try:
+                index[name] = CachedSize.objects.create(content_type=content_type,
+                                                        object_id=self._get_pk_val(),
+                                                        size=name,
+                                                        width=entry.width,
+                                                        height=entry.height,
+                                                        filesize=entry.filesize)
+            except IntegrityError:
+                pass
+
     def _get_SIZE_photosize(self, size):
         return PhotoSizeCache().sizes.get(size)
 
@@ -301,16 +666,44 @@ class ImageModel(models.Model):
         photosize = PhotoSizeCache().sizes.get(size)
         if not self.size_exists(photosize):
             self.create_size(photosize)
+        entry = self._get_size_index().get(photosize.name)
+        if entry is not None:
+            return (entry.width, entry.height)
         return Image.open(self._get_SIZE_filename(size)).size
 
     def _get_SIZE_url(self, size):
         photosize = PhotoSizeCache().sizes.get(size)
-        if not self.size_exists(photosize):
-            self.create_size(photosize)
         if photosize.increment_count:
             self.increment_count()
+        return self._get_url_for_size(photosize)
+
+    def _get_url_for_size(self, photosize):
+        """ Returns the url of photosize without counting a view. """
+        if not self.size_exists(photosize):
+            queue = RenderQueue()
+            if queue.enabled():
+                queue.enqueue(self, photosize)
+                return self._get_fallback_url(photosize)
+            self.create_size(photosize)
         return '/'.join([self.cache_url(), self._get_filename_for_size(photosize.name)])
 
+    def _get_fallback_url(self, photosize):
+        """ Returns the url to serve while photosize is being rendered.
+
+        This is the cached size closest in dimensions to photosize, the
+        PHOTOLOGUE_PLACEHOLDER_URL setting or the original image.
+        """
+        cached = [s for s in PhotoSizeCache().sizes.values()
+                  if s.name != photosize.name and self.size_exists(s)]
+        if cached:
+            def distance(s):
+                return abs(s.width - photosize.width) + abs(s.height - photosize.height)
+            cached.sort(key=distance)
+            return '/'.join([self.cache_url(), self._get_filename_for_size(cached[0].name)])
+        if PHOTOLOGUE_PLACEHOLDER_URL is not None:
+            return PHOTOLOGUE_PLACEHOLDER_URL
+        return self.image.url
+
     def _get_SIZE_filename(self, size):
         photosize = PhotoSizeCache().sizes.get(size)
         return os.path.join(self.cache_path(),
@@ -318,25 +711,73 @@ class ImageModel(models.Model):
 
     def increment_count(self):
         self.view_count += 1
-        models.Model.save(self)
-
-    def add_accessor_methods(self, *args, **kwargs):
-        for size in PhotoSizeCache().sizes.keys():
-            setattr(self, 'get_%s_size' % size,
-                    curry(self._get_SIZE_size, size=size))
-            setattr(self, 'get_%s_photosize' % size,
-                    curry(self._get_SIZE_photosize, size=size))
-            setattr(self, 'get_%s_url' % size,
-                    curry(self._get_SIZE_url, size=size))
-            setattr(self, 'get_%s_filename' % size,
-                    curry(self._get_SIZE_filename, size=size))
+        self._pending_views = getattr(self, '_pending_views', 0) + 1
+        ViewCounter().increment(self)
+
+    def __getattr__(self, name):
+        """ Resolves the get_<size>_size, get_<size>_photosize, get_<size>_url
+        and get_<size>_filename accessors of every defined photo size.
+
+        Only called for attributes not found the normal way, so the accessors
+        cost nothing until they're used.
+        """
+        match = SIZE_ACCESSOR_RE.match(name)
+        if match is not None:
+            size, kind = match.groups()
+            if size in PhotoSizeCache().sizes:
+                return curry(getattr(self, '_get_SIZE_%s' % kind), size=size)
+        raise AttributeError(name)
+
+    def _get_size_index(self):
+        """ Returns the CachedSize entries of this photo keyed by size name.
+
+        Loaded with a single query the first time it's needed, or ahead of
+        time for a list of photos with CachedSize.objects.prefetch.
+        """
+        if not hasattr(self, '_size_index'):
+            if self._get_pk_val() is None:
+                return {}
+            self._size_index = CachedSize.objects.for_object(self)
+        return self._size_index
+
+    def _index_size(self, photosize, im, filename):
+        if self._get_pk_val() is None:
+            return
+        content_type = ContentType.objects.get_for_model(self)
+        CachedSize.objects.filter(content_type=content_type,
+                                  object_id=self._get_pk_val(),
+                                  size=photosize.name).delete()
+        try:
+            entry = CachedSize.objects.create(content_type=content_type,
+                                              object_id=self._get_pk_val(),
+                                              size=photosize.name,
+                                              width=im.size[0],
+                                              height=im.size[1],
+                                              filesize=os.path.getsize(filename))
+        except IntegrityError:
+            # another process rendered the same size concurrently
+            return
+        self._get_size_index()[photosize.name] = entry
 
     def size_exists(self, photosize):
-        func = getattr(self, "get_%s_filename" % photosize.name, None)
-        if func is not None:
-            if os.path.isfile(func()):
-                return True
-        return False
+        if self._get_pk_val() is not None and photosize.name in self._get_size_index():
+            return True
+        filename = os.path.join(self.cache_path(),
+                                self._get_filename_for_size(photosize))
+        if not os.path.isfile(filename):
+            return False
+        if self._get_pk_val() is not None:
+            dropped = cache.get(SIZE_DROPPED_KEY % photosize.name)
+            if dropped is not None and os.path.getmtime(filename) <= dropped:
+                return False
+            # rendered before the index was kept, record it instead of
+            # rendering it again
+            try:
+                im = Image.open(filename)
+            except IOError:
+                return False
+            self._index_size(photosize, im, filename)
+        return True
 
     def resize_image(self, im, photosize):
         cur_width, cur_height = im.size
@@ -387,26 +828,88 @@ class ImageModel(models.Model):
             im = Image.open(self.image.path)
         except IOError:
             return
-        # Save the original format
+        self._render_size(im, im.format, photosize)
+
+    def create_sizes(self, photosizes):
+        """ Creates several photo sizes from a single decode of the original.
+
+        JPEG originals are decoded at reduced scale when every size is much
+        smaller than the original. Sizes are then rendered from the largest to
+        the smallest, each from a working copy downscaled along the way.
+        """
+        photosizes = [s for s in photosizes if not self.size_exists(s)]
+        if not photosizes:
+            return
+        if not os.path.isdir(self.cache_path()):
+            os.makedirs(self.cache_path())
+        try:
+            im = Image.open(self.image.path)
+        except IOError:
+            return
         im_format = im.format
+        if (0, 0) not in [s.size for s in photosizes]:
+            longest = max([max(s.size) for s in photosizes])
+            im.draft(im.mode, (longest, longest))
+        im.load()
+        width, height = im.size
+        scales = [(self._get_scale(s, width, height), s) for s in photosizes]
+        scales.sort(key=lambda x: x[0], reverse=True)
+        base, base_scale = im, 1.0
+        for scale, photosize in scales:
+            # Shrink the working copy from the previous, larger one, keeping
+            # it at twice the target scale so the final antialiased resize
+            # still has enough detail to work with.
+            if scale * 2 < base_scale:
+                base_scale = scale * 2
+                base = base.resize((int(round(width * base_scale)),
+                                  int(round(height * base_scale))), Image.ANTIALIAS)
+            self._render_size(base, im_format, photosize)
+
+    def _get_scale(self, photosize, width, height):
+        """ Returns the factor an image of the given dimensions is scaled by
+        to produce photosize, in either orientation.
+        """
+        if photosize.size == (0, 0):
+            return 1.0
+        scales = []
+        for w, h in ((width, height), (height, width)):
+            new_width, new_height = photosize.size
+            if photosize.crop:
+                ratio = max(float(new_width)/w, float(new_height)/h)
+            elif new_width == 0:
+                ratio = float(new_height)/h
+            elif new_height == 0:
+                ratio = float(new_width)/w
+            else:
+                ratio = min(float(new_width)/w, float(new_height)/h)
+            scales.append(ratio)
+        return min(max(scales), 1.0)
+
+    def _render_size(self, im, im_format, photosize):
+        effect = self.effect
+        if effect is None:
+            effect = photosize.effect
         # Apply effect if found
-        if self.effect is not None:
-            im = self.effect.pre_process(im)
-        elif photosize.effect is not None:
-            im = photosize.effect.pre_process(im)
+        if effect is not None:
+            im = effect.pre_process(im)
         # Resize/crop image
         if im.size != photosize.size and photosize.size != (0, 0):
             im = self.resize_image(im, photosize)
+        if effect is not None:
+            im = effect.resized_process(im)
         # Apply watermark if found
         if photosize.watermark is not None:
             im = photosize.watermark.post_process(im)
         # Apply effect if found
-        if self.effect is not None:
-            im = self.effect.post_process(im)
-        elif photosize.effect is not None:
-            im = photosize.effect.post_process(im)
+        if effect is not None:
+            im = effect.post_process(im)
         # Save file
-        im_filename = getattr(self, "get_%s_filename" % photosize.name)()
+        im_filename = os.path.join(self.cache_path(),
+                                   self._get_filename_for_size(photosize))
+        self._save_size(im, im_format, photosize, im_filename)
+        self._index_size(photosize, im, im_filename)
+
+    def _save_size(self, im, im_format, photosize, im_filename):
         try:
             if im_format != 'JPEG':
                 try:
@@ -420,26 +923,32 @@ class ImageModel(models.Model):
                 os.unlink(im_filename)
             raise e
 
-    def remove_size(self, photosize, remove_dirs=True):
-        if not self.size_exists(photosize):
-            return
-        filename = getattr(self, "get_%s_filename" % photosize.name)()
-        if os.path.isfile(filename):
-            os.remove(filename)
+    def remove_size(self, photosize, remove_dirs=True, keep_shared=True):
+        """ Drops photosize for this photo. Pass keep_shared=False when the
+        size itself is being flushed or reset, so a file shared with a
+        duplicate goes as well.
+        """
+        self._remove_size_files([photosize.name], keep_shared)
+        if self._get_pk_val() is not None:
+            CachedSize.objects.filter(content_type=ContentType.objects.get_for_model(self),
+                                      object_id=self._get_pk_val(),
+                                      size=photosize.name).delete()
+            if hasattr(self, '_size_index'):
+                self._size_index.pop(photosize.name, None)
         if remove_dirs:
             self.remove_cache_dirs()
 
     def clear_cache(self):
-        cache = PhotoSizeCache()
-        for photosize in cache.sizes.values():
-            self.remove_size(photosize, False)
+        self._remove_size_files(PhotoSizeCache().sizes.keys())
+        if self._get_pk_val() is not None:
+            CachedSize.objects.filter(content_type=ContentType.objects.get_for_model(self),
+                                      object_id=self._get_pk_val()).delete()
+            self._size_index = {}
         self.remove_cache_dirs()
 
     def pre_cache(self):
         cache = PhotoSizeCache()
-        for photosize in cache.sizes.values():
-            if photosize.pre_cache:
-                self.create_size(photosize)
+        self.create_sizes([s for s in cache.sizes.values() if s.pre_cache])
 
     def remove_cache_dirs(self):
         try:
@@ -448,27 +957,45 @@ class ImageModel(models.Model):
             pass
 
     def save(self, *args, **kwargs):
+        # read the EXIF tags once, when the photo or its image is new
+        tags = None
+        if self._get_pk_val() is None or self._get_metadata().image != self.image.name:
+            tags = self._read_exif()
         if self.date_taken is None:
             try:
-                exif_date = self.EXIF.get('EXIF DateTimeOriginal', None)
+                if tags is None:
+                    tags = self.EXIF
+                exif_date = tags.get('EXIF DateTimeOriginal', None)
                 if exif_date is not None:
-                    d, t = str.split(exif_date.values)
-                    year, month, day = d.split(':')
-                    hour, minute, second = t.split(':')
-                    self.date_taken = datetime(int(year), int(month), int(day),
-                                               int(hour), int(minute), int(second))
+                    self.date_taken = parse_exif_date(exif_date)
             except:
                 pass
         if self.date_taken is None:
             self.date_taken = datetime.now()
         if self._get_pk_val():
-            self.clear_cache()
+            # the cached files are named after the stored image, effect and
+            # crop, which may be about to change
+            try:
+                self.__class__._default_manager.get(pk=self._get_pk_val()).clear_cache()
+            except self.DoesNotExist:
+                pass
+            self._size_index = {}
+            # view_count is about to be written as is, so the increments
+            # already applied to this instance must not be flushed again.
+            ViewCounter().discard(self, getattr(self, '_pending_views', 0))
+            self._pending_views = 0
         super(ImageModel, self).save(*args, **kwargs)
+        if tags is not None:
+            self._store_metadata(tags)
+            self._adopt_sizes()
         self.pre_cache()
 
     def delete(self):
         assert self._get_pk_val() is not None, "%s object can't be deleted because its %s attribute is set to None." % (self._meta.object_name, self._meta.pk.attname)
         self.clear_cache()
+        ViewCounter().discard(self)
+        PhotoMetadata.objects.filter(content_type=ContentType.objects.get_for_model(self),
+                                     object_id=self._get_pk_val()).delete()
         super(ImageModel, self).delete()
 
 
@@ -554,11 +1081,15 @@ class BaseEffect(models.Model):
     def pre_process(self, im):
         return im
 
+    def resized_process(self, im):
+        return im
+
     def post_process(self, im):
         return im
 
     def process(self, im):
         im = self.pre_process(im)
+        im = self.resized_process(im)
         im = self.post_process(im)
         return im
 
@@ -575,13 +1106,15 @@ class BaseEffect(models.Model):
             pass
         models.Model.save(self, *args, **kwargs)
         self.create_sample()
-        for size in self.photo_sizes.all():
-            size.clear_cache()
-        # try to clear all related subclasses of ImageModel
-        for prop in [prop for prop in dir(self) if prop[-8:] == '_related']:
-            for obj in getattr(self, prop).all():
-                obj.clear_cache()
-                obj.pre_cache()
+        self.clear_cache()
+
+    def clear_cache(self):
+        """ Drops the rendered sizes that use this effect, they are rendered
+        again when next requested or in the background.
+        """
+        sizes = list(self.photo_sizes.all())
+        for cls in ImageModel.__subclasses__():
+            CachedSize.objects.invalidate(cls, sizes)
 
     def delete(self):
         try:
@@ -607,23 +1140,97 @@ class PhotoEffect(BaseEffect):
         verbose_name = _("photo effect")
         verbose_name_plural = _("photo effects")
 
+    def save(self, *args, **kwargs):
+        if hasattr(self, '_plan'):
+            del self._plan
+        super(PhotoEffect, self).save(*args, **kwargs)
+
+    def clear_cache(self):
+        sizes = list(self.photo_sizes.all())
+        all_sizes = list(PhotoSize.objects.all())
+        for cls in ImageModel.__subclasses__():
+            # an effect set on the photo replaces the one of the size
+            CachedSize.objects.invalidate(cls, sizes,
+                                          exclude_ids=cls.objects.filter(effect__isnull=False).values('pk'))
+            CachedSize.objects.invalidate(cls, all_sizes,
+                                          object_ids=cls.objects.filter(effect=self).values('pk'))
+
+    def get_plan(self):
+        """ Compiles the effect into (filters, deferred). Enhancements that
+        only map pixel values are deferred until after the photo has been
+        resized, unless sharpening or filters depend on the full resolution.
+        """
+        if not hasattr(self, '_plan'):
+            filters = []
+            for name in self.filters.split('->'):
+                image_filter = getattr(ImageFilter, name.upper(), None)
+                if image_filter is not None:
+                    filters.append(image_filter)
+            self._plan = (filters, not filters and self.sharpness == 1.0)
+        return self._plan
+
+    def enhance_matrix(self, im):
+        """ Returns the convert() matrix applying color, brightness and
+        contrast to im in one pass, or None if they leave it unchanged.
+        """
+        if self.color == self.brightness == self.contrast == 1.0:
+            return None
+        # ImageEnhance.Color blends with the luma of the image, Brightness
+        # with black and Contrast with the mean luma after brightness
+        luma = (0.299, 0.587, 0.114)
+        scale = self.brightness * self.contrast
+        offset = 0
+        if self.contrast != 1.0:
+            hist = im.convert('L').histogram()
+            mean = sum([i * n for i, n in enumerate(hist)]) / float(sum(hist))
+            offset = int(mean * self.brightness + 0.5) * (1.0 - self.contrast)
+        matrix = []
+        for band in range(3):
+            for i in range(3):
+                weight = (1.0 - self.color) * luma[i]
+                if i == band:
+                    weight += self.color
+                matrix.append(weight * scale)
+            matrix.append(offset)
+        return tuple(matrix)
+
+    def enhance(self, im):
+        """ Applies color, brightness, contrast and sharpness. """
+        matrix = self.enhance_matrix(im)
+        if matrix is not None:
+            if im.mode == 'RGBA':
+                alpha = im.split()[3]
+                im = im.convert('RGB').convert('RGB', matrix)
+                im.putalpha(alpha)
+            else:
+                im = im.convert('RGB', matrix)
+        if self.sharpness != 1.0:
+            im = ImageEnhance.Sharpness(im).enhance(self.sharpness)
+        return im
+
     def pre_process(self, im):
         if self.transpose_method != '':
             method = getattr(Image, self.transpose_method)
             im = im.transpose(method)
         if im.mode != 'RGB' and im.mode != 'RGBA':
             return im
-        for name in ['Color', 'Brightness', 'Contrast', 'Sharpness']:
-            factor = getattr(self, name.lower())
-            if factor != 1.0:
-                im = getattr(ImageEnhance, name)(im).enhance(factor)
-        for name in self.filters.split('->'):
-            image_filter = getattr(ImageFilter, name.upper(), None)
-            if image_filter is not None:
-                try:
-                    im = im.filter(image_filter)
-                except ValueError:
-                    pass
+        filters, deferred = self.get_plan()
+        if deferred:
+            return im
+        im = self.enhance(im)
+        for image_filter in filters:
+            try:
+                im = im.filter(image_filter)
+            except ValueError:
+                pass
+        return im
+
+    def resized_process(self, im):
+        if im.mode != 'RGB' and im.mode != 'RGBA':
+            return im
+        filters, deferred = self.get_plan()
+        if deferred:
+            im = self.enhance(im)
         return im
 
     def post_process(self, im):
@@ -641,9 +1248,13 @@ class Watermark(BaseEffect):
         verbose_name = _('watermark')
         verbose_name_plural = _('watermarks')
 
+    layers = LayerCache(WATERMARK_CACHE_SIZE)
+
     def post_process(self, im):
-        mark = Image.open(self.image.path)
-        return apply_watermark(im, mark, self.style, self.opacity)
+        key = (self.pk, self.image.name, im.size, self.style, self.opacity)
+        layer = self.layers.get(key, lambda: prepare_layer(Image.open(self.image.path), im.size,
+                                                           self.style, self.opacity))
+        return apply_layer(im, layer)
 
 
 class PhotoSize(models.Model):
@@ -670,24 +1281,39 @@ class PhotoSize(models.Model):
         return self.__unicode__()
 
     def clear_cache(self):
+        """ Drops this size for every photo, it is rendered again when next
+        requested or in the background.
+        """
         for cls in ImageModel.__subclasses__():
-            for obj in cls.objects.all():
-                obj.remove_size(self)
-                if self.pre_cache:
-                    obj.create_size(self)
-        PhotoSizeCache().reset()
+            CachedSize.objects.invalidate(cls, [self])
 
     def save(self, *args, **kwargs):
         if self.crop is True:
             if self.width == 0 or self.height == 0:
                 raise ValueError("PhotoSize width and/or height can not be zero if crop=True.")
+        changed = False
+        old = None
+        if self._get_pk_val() is not None:
+            try:
+                old = PhotoSize.objects.get(pk=self._get_pk_val())
+            except PhotoSize.DoesNotExist:
+                pass
+        if old is not None:
+            if old.name != self.name:
+                # files rendered under the old name would never be used again
+                for cls in ImageModel.__subclasses__():
+                    CachedSize.objects.invalidate(cls, [old], render=False)
+            fields = ('width', 'height', 'quality', 'upscale', 'crop', 'effect_id', 'watermark_id')
+            changed = [getattr(old, f) for f in fields] != [getattr(self, f) for f in fields]
         super(PhotoSize, self).save(*args, **kwargs)
-        PhotoSizeCache().reset()
-        self.clear_cache()
+        if changed:
+            self.clear_cache()
 
     def delete(self):
         assert self._get_pk_val() is not None, "%s object can't be deleted because its %s attribute is set to None." % (self._meta.object_name, self._meta.pk.attname)
-        self.clear_cache()
+        # nothing will render this size again, so its files go as well
+        for cls in ImageModel.__subclasses__():
+            CachedSize.objects.invalidate(cls, [self], render=False)
         super(PhotoSize, self).delete()
 
     def _get_size(self):
@@ -697,29 +1323,306 @@ class PhotoSize(models.Model):
     size = property(_get_size, _set_size)
 
 
+class CachedSizeManager(models.Manager):
+    def invalidate(self, model, photosizes, object_ids=None, exclude_ids=None, render=True):
+        """ Drops the entries of photosizes for the photos of model, limited
+        to object_ids and leaving out exclude_ids when given, so they are
+        rendered again when next requested. Their files are removed in the
+        background when background rendering is enabled, along with
+        rendering the pre-cached sizes again unless render is False.
+        """
+        if not photosizes:
+            return
+        names = [s.name for s in photosizes]
+        entries = self.filter(content_type=ContentType.objects.get_for_model(model),
+                              size__in=names)
+        if object_ids is not None:
+            entries = entries.filter(object_id__in=object_ids)
+        if exclude_ids is not None:
+            entries = entries.exclude(object_id__in=exclude_ids)
+        dropped = {}
+        for object_id, size in entries.values_list('object_id', 'size').iterator():
+            dropped.setdefault(object_id, []).append(size)
+        since = time.time()
+        for name in names:
+            cache.set(SIZE_DROPPED_KEY % name, since, SIZE_DROPPED_TIMEOUT)
+        entries.delete()
+        queue = RenderQueue()
+        pks = sorted(dropped.keys())
+        for start in range(0, len(pks), INVALIDATE_CHUNK_SIZE):
+            chunk = dict([(pk, dropped[pk]) for pk in pks[start:start + INVALIDATE_CHUNK_SIZE]])
+            if queue.enabled():
+                queue.remove(model, chunk, since)
+            else:
+                self.remove_files(model, chunk)
+        pre_cache = dict([(s.name, s) for s in photosizes if s.pre_cache])
+        if render and pre_cache and queue.enabled():
+            for object_id in pks:
+                for size in dropped[object_id]:
+                    if size in pre_cache:
+                        queue.enqueue_pk(model, object_id, pre_cache[size])
+
+    def remove_files(self, model, sizes, since=None):
+        """ Deletes the files of dropped sizes, given as the size names of
+        each photo of model keyed by primary key. The files of sizes indexed
+        or rendered again since the time since are kept.
+        """
+        indexed = set(self.filter(content_type=ContentType.objects.get_for_model(model),
+                                  object_id__in=sizes.keys()).values_list('object_id', 'size'))
+        for obj in model._default_manager.filter(pk__in=sizes.keys()).iterator():
+            names = [name for name in sizes[obj._get_pk_val()]
+                     if (obj._get_pk_val(), name) not in indexed]
+            obj._remove_size_files(names, since=since)
+
+    def for_object(self, obj):
+        """ Returns the entries for obj keyed by size name. """
+        entries = self.filter(content_type=ContentType.objects.get_for_model(obj),
+                              object_id=obj._get_pk_val())
+        return dict([(entry.size, entry) for entry in entries])
+
+    def prefetch(self, objs):
+        """ Loads the size index of every photo in objs, one query per model. """
+        by_model = {}
+        for obj in objs:
+            by_model.setdefault(obj.__class__, []).append(obj)
+        for model, instances in by_model.items():
+            index = dict([(obj._get_pk_val(), {}) for obj in instances])
+            entries = self.filter(content_type=ContentType.objects.get_for_model(model),
+                                  object_id__in=index.keys())
+            for entry in entries:
+                index[entry.object_id][entry.size] = entry
+            for obj in instances:
+                obj._size_index = index[obj._get_pk_val()]
+
+
+class CachedSize(models.Model):
+    """ Records a rendered photo size, so the size accessors don't have to
+    stat or open files in the cache directory.
+    """
+    content_type = models.ForeignKey(ContentType)
+    object_id = models.PositiveIntegerField()
+    size = models.CharField(_('size'), max_length=20)
+    width = models.PositiveIntegerField(_('width'))
+    height = models.PositiveIntegerField(_('height'))
+    filesize = models.PositiveIntegerField(_('file size'))
+
+    objects = CachedSizeManager()
+
+    class Meta:
+        unique_together = (('content_type', 'object_id', 'size'),)
+        verbose_name = _('cached size')
+        verbose_name_plural = _('cached sizes')
+
+    def __unicode__(self):
+        return u'%s %s %s' % (self.content_type, self.object_id, self.size)
+
+
+def parse_exif_date(tag):
+    """ Returns the datetime of an EXIF 'YYYY:MM:DD HH:MM:SS' tag. """
+    d, t = str(tag.values).split()
+    year, month, day = d.split(':')
+    hour, minute, second = t.split(':')
+    return datetime(int(year), int(month), int(day),
+                    int(hour), int(minute), int(second))
+
+
+def exif_ratio(value):
+    if isinstance(value, EXIF.Ratio):
+        return float(value.num) / value.den
+    return float(value)
+
+
+def exif_coordinate(tag, ref):
+    """ Returns a GPS degrees, minutes, seconds tag as signed degrees. """
+    degrees = 0.0
+    for i, value in enumerate(tag.values[:3]):
+        degrees += exif_ratio(value) / 60 ** i
+    if ref is not None and str(ref.printable).strip() in ('S', 'W'):
+        degrees = -degrees
+    return degrees
+
+
+class PhotoMetadata(models.Model):
+    """ The EXIF tags of a photo, read from the original once when the photo
+    is saved so that later reads don't have to touch the file.
+
+    The tags that are searched on are also kept in columns of their own. The
+    size and modification time of the original tell the plexif command which
+    photos have to be read again.
+    """
+    content_type = models.ForeignKey(ContentType)
+    object_id = models.PositiveIntegerField()
+    image = models.CharField(_('image'), max_length=100)
+    exif = models.TextField(_('EXIF'), blank=True)
+    date_taken = models.DateTimeField(_('date taken'), null=True, blank=True, db_index=True)
+    camera_make = models.CharField(_('camera make'), max_length=64, blank=True)
+    camera_model = models.CharField(_('camera model'), max_length=64, blank=True)
+    exposure_time = models.CharField(_('exposure time'), max_length=16, blank=True)
+    f_number = models.FloatField(_('f-number'), null=True, blank=True)
+    latitude = models.FloatField(_('latitude'), null=True, blank=True)
+    longitude = models.FloatField(_('longitude'), null=True, blank=True)
+    orientation = models.PositiveSmallIntegerField(_('orientation'), null=True, blank=True)
+    file_size = models.PositiveIntegerField(null=True, editable=False)
+    file_mtime = models.FloatField(null=True, editable=False)
+
+    class Meta:
+        unique_together = (('content_type', 'object_id'),)
+        verbose_name = _('photo metadata')
+        verbose_name_plural = _('photo metadata')
+
+    def __unicode__(self):
+        return self.image
+
+    def get_tags(self):
+        """ Returns the stored tags as EXIF.IFD_Tag objects keyed by name. """
+        if not hasattr(self, '_tags'):
+            printables = self.exif and simplejson.loads(self.exif) or {}
+            self._tags = dict([(name, EXIF.IFD_Tag(printable, None, 0, printable, None, None))
+                               for name, printable in printables.items()])
+        return self._tags
+
+    def set_tags(self, tags):
+        printables = {}
+        for name, tag in tags.items():
+            if name not in EXIF_SKIPPED_TAGS:
+                printable = tag.printable
+                if isinstance(printable, str):
+                    printable = printable.decode('utf-8', 'replace')
+                printables[name] = printable
+        self.exif = simplejson.dumps(printables)
+        if hasattr(self, '_tags'):
+            del self._tags
+        self.set_columns(tags)
+
+    def set_columns(self, tags):
+        """ Copies the searchable tags into their columns. """
+        def printable(name):
+            tag = tags.get(name)
+            if tag is None:
+                return ''
+            value = tag.printable
+            if isinstance(value, str):
+                value = value.decode('utf-8', 'replace')
+            return unicode(value).strip()
+        self.camera_make = printable('Image Make')[:64]
+        self.camera_model = printable('Image Model')[:64]
+        self.exposure_time = printable('EXIF ExposureTime')[:16]
+        for field, parse in (('date_taken', lambda: parse_exif_date(tags['EXIF DateTimeOriginal'])),
+                             ('f_number', lambda: exif_ratio(tags['EXIF FNumber'].values[0])),
+                             ('orientation', lambda: int(tags['Image Orientation'].values[0])),
+                             ('latitude', lambda: exif_coordinate(tags['GPS GPSLatitude'],
+                                                                  tags.get('GPS GPSLatitudeRef'))),
+                             ('longitude', lambda: exif_coordinate(tags['GPS GPSLongitude'],
+                                                                   tags.get('GPS GPSLongitudeRef')))):
+            try:
+                setattr(self, field, parse())
+            except Exception:
+                setattr(self, field, None)
+
+    def set_file_stat(self, path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            self.file_size = self.file_mtime = None
+        else:
+            self.file_size, self.file_mtime = st.st_size, st.st_mtime
+
+    def is_current(self, image, path):
+        """ Returns True if the tags were read from image as it is on disk now. """
+        if self.image != image or self.file_size is None:
+            return False
+        try:
+            st = os.stat(path)
+        except OSError:
+            return False
+        return (self.file_size, self.file_mtime) == (st.st_size, st.st_mtime)
+
+
 class PhotoSizeCache(object):
-    __state = {"sizes": {}}
+    """ Per-process cache of the photo size definitions.
+
+    A generation counter kept in the cache backend is bumped whenever a photo
+    size, effect or watermark changes. Each process compares it with the
+    generation it loaded at most once per request, or every
+    PHOTOSIZE_CHECK_INTERVAL seconds outside of requests, and reloads the
+    sizes only when they differ.
+    """
+    __state = {"sizes": {}, "loaded": False, "checked": 0, "generation": None}
 
     def __init__(self):
         self.__dict__ = self.__state
-        if not len(self.sizes):
-            sizes = PhotoSize.objects.all()
-            for size in sizes:
-                self.sizes[size.name] = size
+        now = time.time()
+        if now - self.checked >= PHOTOSIZE_CHECK_INTERVAL:
+            self.checked = now
+            generation = cache.get(PHOTOSIZE_GENERATION_KEY)
+            if generation != self.generation:
+                self.generation = generation
+                self.loaded = False
+        if not self.loaded:
+            self.sizes = dict([(size.name, size) for size in PhotoSize.objects.all()])
+            self.loaded = True
+
+    @classmethod
+    def reset(cls):
+        """ Reloads the sizes here and, through the shared cache backend, in
+        every other process. """
+        try:
+            generation = cache.incr(PHOTOSIZE_GENERATION_KEY)
+        except (ValueError, TypeError):
+            # missing, or not a counter
+            generation = 1
+            cache.set(PHOTOSIZE_GENERATION_KEY, generation)
+        cls.__state.update({'sizes': {}, 'loaded': False, 'generation': generation})
 
-    def reset(self):
-        self.sizes = {}
+    @classmethod
+    def expire(cls):
+        """ Makes the next instance check the shared generation counter. """
+        cls.__state['checked'] = 0
 
 
-# Set up the accessor methods
-def add_methods(sender, instance, signal, *args, **kwargs):
-    """ Adds methods to access sized images (urls, paths)
+def expire_photosizes(sender, **kwargs):
+    PhotoSizeCache.expire()
 
-    after the Photo model's __init__ function completes,
-    this method calls "add_accessor_methods" on each instance.
-    """
-    if hasattr(instance, 'add_accessor_methods'):
-        instance.add_accessor_methods()
+def reset_photosizes(sender, **kwargs):
+    PhotoSizeCache.reset()
+
+def clear_gallery_photo_lists(sender, instance, **kwargs):
+    if isinstance(instance, Gallery):
+        gallery_ids = [instance.pk]
+    else:
+        gallery_ids = list(instance.galleries.values_list('pk', flat=True))
+    Gallery.objects.clear_photo_lists(gallery_ids)
+
+def clear_changed_photo_lists(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    if not reverse:
+        gallery_ids = [instance.pk]
+    elif pk_set is not None:
+        gallery_ids = pk_set
+    else:
+        gallery_ids = list(instance.galleries.values_list('pk', flat=True))
+    Gallery.objects.clear_photo_lists(gallery_ids)
+
+request_started.connect(expire_photosizes)
+post_save.connect(reset_photosizes, sender=PhotoSize)
+post_delete.connect(reset_photosizes, sender=PhotoSize)
+post_save.connect(reset_photosizes, sender=PhotoEffect)
+post_delete.connect(reset_photosizes, sender=PhotoEffect)
+post_save.connect(reset_photosizes, sender=Watermark)
+post_delete.connect(reset_photosizes, sender=Watermark)
+post_save.connect(clear_gallery_photo_lists, sender=Gallery)
+post_delete.connect(clear_gallery_photo_lists, sender=Gallery)
+post_save.connect(clear_gallery_photo_lists, sender=Photo)
+# the gallery links of a photo are gone by the time post_delete is sent
+pre_delete.connect(clear_gallery_photo_lists, sender=Photo)
+
+try:
+    from django.db.models.signals import m2m_changed
+except ImportError:
+    # Django 1.1 sends no signal for many-to-many changes, GalleryAdmin and
+    # GalleryUpload clear the lists themselves
+    pass
+else:
+    m2m_changed.connect(clear_changed_photo_lists, sender=Gallery.photos.through)
 
-# connect the add_accessor_methods function to the post_init signal
-post_init.connect(add_methods)
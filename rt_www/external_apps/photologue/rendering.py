@@ -0,0 +1,129 @@
+""" Background rendering of Photologue photo sizes.
+
+Jobs are identified by (app_label, model name, primary key, size name) so
+they can be handed to a pool of worker processes. Each worker looks the
+photo up again and calls ImageModel.create_size, so rendered files end up
+at exactly the same paths as a synchronous render would produce. The
+files of dropped sizes are removed by the same workers, a chunk of photos
+at a time.
+
+"""
+import sys
+import threading
+import traceback
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import get_model
+
+# Number of worker processes used to render photo sizes in the background.
+# Set to 0 to render sizes synchronously inside the request.
+PHOTOLOGUE_RENDER_WORKERS = getattr(settings, 'PHOTOLOGUE_RENDER_WORKERS', 0)
+
+
+def _init_worker():
+    # The forked worker inherits the parent's database connection; drop the
+    # reference without closing it so the parent's session is left intact.
+    connection.connection = None
+
+
+def pool(processes):
+    """ Returns a multiprocessing pool whose workers open their own database
+    connections.
+    """
+    from multiprocessing import Pool
+    return Pool(processes, _init_worker)
+
+
+def render_size(job):
+    """ Renders a single photo size. Runs inside a worker process.
+
+    Always returns the job so the parent can clear it from the pending set,
+    even if rendering failed.
+    """
+    app_label, model_name, pk, size_name = job
+    try:
+        from models import PhotoSizeCache
+        # workers live across requests, pick up changed size definitions
+        PhotoSizeCache.expire()
+        model = get_model(app_label, model_name)
+        photosize = PhotoSizeCache().sizes.get(size_name)
+        if model is not None and photosize is not None:
+            try:
+                obj = model._default_manager.get(pk=pk)
+            except model.DoesNotExist:
+                return job
+            obj.create_size(photosize)
+    except Exception:
+        traceback.print_exc(file=sys.stderr)
+    return job
+
+
+def remove_sizes(job):
+    """ Deletes the files of sizes dropped from the index for a chunk of
+    photos. Runs inside a worker process.
+    """
+    app_label, model_name, sizes, since = job
+    try:
+        from models import CachedSize
+        model = get_model(app_label, model_name)
+        if model is not None:
+            CachedSize.objects.remove_files(model, sizes, since)
+    except Exception:
+        traceback.print_exc(file=sys.stderr)
+    return job
+
+
+class RenderQueue(object):
+    """ Process-wide queue of pending photo size renders.
+
+    Shares its state between instances in the same way as PhotoSizeCache.
+    """
+    __state = {'pool': None, 'pending': set(), 'lock': threading.Lock()}
+
+    def __init__(self):
+        self.__dict__ = self.__state
+
+    def enabled(self):
+        return PHOTOLOGUE_RENDER_WORKERS > 0
+
+    def _get_pool(self):
+        if self.pool is None:
+            self.pool = pool(PHOTOLOGUE_RENDER_WORKERS)
+        return self.pool
+
+    def _done(self, job):
+        self.lock.acquire()
+        try:
+            self.pending.discard(job)
+        finally:
+            self.lock.release()
+
+    def enqueue(self, obj, photosize):
+        """ Schedules photosize to be rendered for obj.
+
+        Returns False if the job was already pending.
+        """
+        return self.enqueue_pk(obj.__class__, obj._get_pk_val(), photosize)
+
+    def enqueue_pk(self, model, pk, photosize):
+        """ Schedules photosize to be rendered for the photo of the given
+        model and primary key, without loading it.
+        """
+        job = (model._meta.app_label, model._meta.object_name, pk, photosize.name)
+        self.lock.acquire()
+        try:
+            if job in self.pending:
+                return False
+            self.pending.add(job)
+        finally:
+            self.lock.release()
+        self._get_pool().apply_async(render_size, (job,), callback=self._done)
+        return True
+
+    def remove(self, model, sizes, since):
+        """ Schedules the files of dropped sizes to be deleted, sizes holds
+        the size names of each photo of model keyed by primary key.
+        """
+        job = (model._meta.app_label, model._meta.object_name, sizes, since)
+        self._get_pool().apply_async(remove_sizes, (job,))
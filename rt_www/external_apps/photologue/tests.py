@@ -1,10 +1,16 @@
 import os
 import unittest
+import zipfile
+from cStringIO import StringIO
 from django.conf import settings
 from django.core.files.base import ContentFile
 from django.test import TestCase
 
 from models import *
+from counters import ViewCounter, FLUSH_REQUEST_KEY, PHOTOLOGUE_VIEW_COUNT_CHECK_INTERVAL
+from utils.reflection import add_reflection
+from utils.cache import LayerCache
+from utils.watermark import tile
 
 # Path to sample image
 RES_DIR = os.path.join(os.path.dirname(__file__), 'res')
@@ -13,6 +19,16 @@ PORTRAIT_IMAGE_PATH = os.path.join(RES_DIR, 'test_portrait.jpg')
 SQUARE_IMAGE_PATH = os.path.join(RES_DIR, 'test_square.jpg')
 
 
+def gradient_image(size=(64, 48)):
+    """ Returns an RGB image with no two neighbouring pixels alike, the
+    sample images are a single color.
+    """
+    im = Image.new('RGB', size)
+    im.putdata([(x * 4 % 256, y * 5 % 256, (x + y) * 2 % 256)
+                for y in range(size[1]) for x in range(size[0])])
+    return im
+
+
 class TestPhoto(ImageModel):
     """ Minimal ImageModel class for testing """
     name = models.CharField(max_length=30)
@@ -45,6 +61,19 @@ class PhotoTest(PLTest):
     #def test_exif(self):
     #    self.assert_(len(self.pl.EXIF.keys()) > 0)
 
+    def test_metadata(self):
+        metadata = PhotoMetadata.objects.get(object_id=self.pl.pk)
+        self.assertEquals(metadata.image, self.pl.image.name)
+        self.assertEquals(sorted(self.pl.EXIF.keys()),
+                          sorted(metadata.get_tags().keys()))
+
+    def test_metadata_is_current(self):
+        metadata = PhotoMetadata.objects.get(object_id=self.pl.pk)
+        self.failUnless(metadata.is_current(self.pl.image.name, self.pl.image.path))
+        st = os.stat(self.pl.image.path)
+        os.utime(self.pl.image.path, (st.st_atime, st.st_mtime + 10))
+        self.failIf(metadata.is_current(self.pl.image.name, self.pl.image.path))
+
     def test_paths(self):
         self.assertEqual(os.path.normpath(str(self.pl.cache_path())).lower(),
                          os.path.normpath(os.path.join(settings.MEDIA_ROOT,
@@ -64,11 +93,32 @@ class PhotoTest(PLTest):
             self.pl.get_test_url()
         self.assertEquals(self.pl.view_count, 5)
 
+    def test_buffered_count(self):
+        self.s.increment_count = True
+        self.s.save()
+        for i in range(5):
+            self.pl.get_test_url()
+        ViewCounter().flush()
+        self.assertEquals(TestPhoto.objects.get(pk=self.pl.pk).view_count, 5)
+
+    def test_flush_request(self):
+        self.s.increment_count = True
+        self.s.save()
+        counter = ViewCounter()
+        counter.flush()
+        self.pl.get_test_url()
+        # plflushcounts run elsewhere, seen once the check interval is up
+        cache.set(FLUSH_REQUEST_KEY, counter.last_flush + 1)
+        counter.last_check -= PHOTOLOGUE_VIEW_COUNT_CHECK_INTERVAL
+        self.pl.get_test_url()
+        self.assertEquals(TestPhoto.objects.get(pk=self.pl.pk).view_count, 2)
+
     def test_precache(self):
         # set the thumbnail photo size to pre-cache
         self.s.pre_cache = True
         self.s.save()
-        # make sure it created the file
+        # make sure saving the photo created the file
+        TestPhoto.objects.get(pk=self.pl.pk).save()
         self.failUnless(os.path.isfile(self.pl.get_test_filename()))
         self.s.pre_cache = False
         self.s.save()
@@ -76,6 +126,129 @@ class PhotoTest(PLTest):
         self.pl.clear_cache()
         self.failIf(os.path.isfile(self.pl.get_test_filename()))
 
+    def test_invalidation(self):
+        self.pl.get_test_url()
+        entries = CachedSize.objects.filter(object_id=self.pl.pk, size='test')
+        self.s.increment_count = True
+        self.s.save()
+        self.assertEquals(entries.count(), 1)
+        self.s.width = 50
+        self.s.save()
+        self.assertEquals(entries.count(), 0)
+        self.failIf(os.path.isfile(self.pl.get_test_filename()))
+        pl = TestPhoto.objects.get(pk=self.pl.pk)
+        self.assertEquals(pl.get_test_size(), (50, 38))
+
+    def test_dropped_size(self):
+        self.pl.get_test_url()
+        # dropped, the stale file waits for a worker to remove it
+        CachedSize.objects.filter(object_id=self.pl.pk).delete()
+        cache.set(SIZE_DROPPED_KEY % 'test', time.time())
+        pl = TestPhoto.objects.get(pk=self.pl.pk)
+        self.failIf(pl.size_exists(self.s))
+        cache.delete(SIZE_DROPPED_KEY % 'test')
+
+    def test_remove_files(self):
+        self.pl.get_test_url()
+        filename = self.pl.get_test_filename()
+        sizes = {self.pl.pk: ['test']}
+        CachedSize.objects.remove_files(TestPhoto, sizes)
+        self.failUnless(os.path.isfile(filename))
+        CachedSize.objects.filter(object_id=self.pl.pk).delete()
+        # rendered again after the size was dropped
+        CachedSize.objects.remove_files(TestPhoto, sizes, time.time() - 60)
+        self.failUnless(os.path.isfile(filename))
+        CachedSize.objects.remove_files(TestPhoto, sizes)
+        self.failIf(os.path.isfile(filename))
+
+    def test_rename_size(self):
+        filename = self.pl.get_test_filename()
+        self.pl.get_test_url()
+        self.s.name = 'test_renamed'
+        self.s.save()
+        self.failIf(os.path.isfile(filename))
+        self.assertEquals(CachedSize.objects.filter(object_id=self.pl.pk).count(), 0)
+        self.s.name = 'test'
+        self.s.save()
+
+    def test_duplicate(self):
+        self.pl.get_test_url()
+        dup = TestPhoto(name='duplicate')
+        dup.image.save('duplicate.jpg', ContentFile(open(LANDSCAPE_IMAGE_PATH, 'rb').read()))
+        self.assertEquals(dup.image.name, self.pl.image.name)
+        self.failUnless(dup.size_exists(self.s))
+        self.assertEquals(dup.get_test_filename(), self.pl.get_test_filename())
+        dup.delete()
+        self.failUnless(os.path.isfile(self.pl.image.path))
+        self.failUnless(os.path.isfile(self.pl.get_test_filename()))
+
+    def test_shared_size_removal(self):
+        self.pl.get_test_url()
+        dup = TestPhoto(name='duplicate')
+        dup.image.save('duplicate.jpg', ContentFile(open(LANDSCAPE_IMAGE_PATH, 'rb').read()))
+        self.failUnless(dup.size_exists(self.s))
+        # still indexed for the original photo
+        dup.remove_size(self.s)
+        self.failUnless(os.path.isfile(self.pl.get_test_filename()))
+        # the size is reset, the original photo has to render it again
+        dup.remove_size(self.s, keep_shared=False)
+        self.failIf(os.path.isfile(self.pl.get_test_filename()))
+        self.assertEquals(CachedSize.objects.filter(object_id=self.pl.pk, size='test').count(), 0)
+        dup.delete()
+
+    def test_crop_change(self):
+        self.pl.get_test_url()
+        filename = self.pl.get_test_filename()
+        self.pl.crop_from = 'top'
+        self.pl.save()
+        self.failIf(os.path.isfile(filename))
+        self.assertNotEquals(self.pl.get_test_filename(), filename)
+
+    def test_fallback_url(self):
+        self.pl.clear_cache()
+        self.assertEquals(self.pl._get_fallback_url(self.s), self.pl.image.url)
+        s2 = PhotoSize(name='test_small', width=50, height=50, pre_cache=True)
+        s2.save()
+        pl = TestPhoto.objects.get(pk=self.pl.pk)
+        self.assertEquals(pl._get_fallback_url(self.s),
+                          pl.cache_url() + '/' + pl._get_filename_for_size(s2))
+        s2.delete()
+
+    def test_create_sizes(self):
+        s2 = PhotoSize(name='test_small', width=50, height=50)
+        s2.save()
+        pl = TestPhoto.objects.get(pk=self.pl.pk)
+        pl.create_sizes([s2, self.s])
+        self.assertEquals(Image.open(pl.get_test_filename()).size, (100, 75))
+        self.assertEquals(Image.open(pl.get_test_small_filename()).size, (50, 38))
+        s2.delete()
+
+    def test_size_index(self):
+        self.pl.get_test_url()
+        entry = CachedSize.objects.get(object_id=self.pl.pk, size='test')
+        self.assertEquals((entry.width, entry.height), (100, 75))
+        self.assertEquals(entry.filesize, os.path.getsize(self.pl.get_test_filename()))
+        self.pl.clear_cache()
+        self.assertEquals(CachedSize.objects.filter(object_id=self.pl.pk).count(), 0)
+        self.failIf(self.pl.size_exists(self.s))
+
+    def test_unindexed_size(self):
+        self.pl.get_test_url()
+        CachedSize.objects.filter(object_id=self.pl.pk).delete()
+        pl = TestPhoto.objects.get(pk=self.pl.pk)
+        mtime = os.path.getmtime(pl.get_test_filename())
+        self.failUnless(pl.size_exists(self.s))
+        entry = CachedSize.objects.get(object_id=self.pl.pk, size='test')
+        self.assertEquals((entry.width, entry.height), (100, 75))
+        self.assertEquals(os.path.getmtime(pl.get_test_filename()), mtime)
+
+    def test_late_size_accessors(self):
+        s2 = PhotoSize(name='test_late', width=50, height=50)
+        s2.save()
+        self.assertEquals(self.pl.get_test_late_photosize(), s2)
+        s2.delete()
+        self.failIf(hasattr(self.pl, 'get_test_late_url'))
+
     def test_accessor_methods(self):
         self.assertEquals(self.pl.get_test_photosize(), self.s)
         self.assertEquals(self.pl.get_test_size(),
@@ -210,9 +383,153 @@ class PhotoEffectTest(PLTest):
         self.assert_(isinstance(effect.post_process(im), Image.Image))
         self.assert_(isinstance(effect.process(im), Image.Image))
 
+    def test_fused_enhance(self):
+        effect = PhotoEffect(name='test', color=0.5, brightness=1.2)
+        im = gradient_image()
+        expected = ImageEnhance.Brightness(ImageEnhance.Color(im).enhance(0.5)).enhance(1.2)
+        fused = effect.enhance(im)
+        for a, b in zip(fused.getdata(), expected.getdata()):
+            self.failUnless(max([abs(x - y) for x, y in zip(a, b)]) <= 2)
+
+    def test_deferred(self):
+        effect = PhotoEffect(name='test', brightness=0.5)
+        im = gradient_image()
+        pixels = list(im.getdata())
+        self.assertEquals(list(effect.pre_process(im).getdata()), pixels)
+        self.assertNotEquals(list(effect.resized_process(im).getdata()), pixels)
+        effect = PhotoEffect(name='test', brightness=0.5, filters='BLUR')
+        self.assertNotEquals(list(effect.pre_process(im).getdata()), pixels)
+        self.assertEquals(list(effect.resized_process(im).getdata()), pixels)
+
+
+class ReflectionTest(unittest.TestCase):
+    def test_reflection(self):
+        im = Image.open(LANDSCAPE_IMAGE_PATH)
+        reflected = add_reflection(im, bgcolor='#ffffff', amount=0.5, opacity=1)
+        self.assertEquals(reflected.size, (im.size[0], im.size[1] * 3 / 2))
+        # at full opacity the first reflected row mirrors the last one
+        self.assertEquals(reflected.getpixel((0, im.size[1])),
+                          im.convert('RGB').getpixel((0, im.size[1] - 1)))
+        # the reflection fades out into the background color
+        self.assertEquals(reflected.getpixel((0, reflected.size[1] - 1)), (255, 255, 255))
+
+
+class WatermarkTest(unittest.TestCase):
+    def test_tile(self):
+        mark = Image.open(SQUARE_IMAGE_PATH).resize((7, 5)).convert('RGBA')
+        expected = Image.new('RGBA', (50, 40), (0, 0, 0, 0))
+        for y in range(0, 40, 5):
+            for x in range(0, 50, 7):
+                expected.paste(mark, (x, y))
+        self.assertEquals(list(tile(mark, (50, 40)).getdata()),
+                          list(expected.getdata()))
+
+    def test_layer_cache(self):
+        layers = LayerCache(2)
+        built = []
+        def build(key):
+            built.append(key)
+            return key
+        for key in ('a', 'b', 'a', 'c', 'a', 'b'):
+            layers.get(key, lambda: build(key))
+        self.assertEquals(built, ['a', 'b', 'c', 'b'])
+
 
 class PhotoSizeCacheTest(PLTest):
+    def tearDown(self):
+        super(PhotoSizeCacheTest, self).tearDown()
+        cache.delete(PHOTOSIZE_GENERATION_KEY)
+
     def test(self):
         cache = PhotoSizeCache()
         self.assertEqual(cache.sizes['test'], self.s)
 
+    def test_generation(self):
+        generation = PhotoSizeCache().generation
+        self.s.width = 50
+        self.s.save()
+        self.assertNotEqual(PhotoSizeCache().generation, generation)
+        self.assertEqual(PhotoSizeCache().sizes['test'].width, 50)
+
+    def test_reset_restarts_counter(self):
+        cache.set(PHOTOSIZE_GENERATION_KEY, 'not a counter')
+        PhotoSizeCache.reset()
+        self.assertEqual(cache.get(PHOTOSIZE_GENERATION_KEY), 1)
+
+    def test_check_interval(self):
+        PhotoSizeCache()
+        # another process changes the size
+        PhotoSize.objects.filter(pk=self.s.pk).update(width=60)
+        cache.set(PHOTOSIZE_GENERATION_KEY, (cache.get(PHOTOSIZE_GENERATION_KEY) or 0) + 1)
+        self.assertEqual(PhotoSizeCache().sizes['test'].width, 100)
+        PhotoSizeCache._PhotoSizeCache__state['checked'] -= PHOTOSIZE_CHECK_INTERVAL
+        self.assertEqual(PhotoSizeCache().sizes['test'].width, 60)
+
+
+class GalleryPhotoListTest(PLTest):
+    def setUp(self):
+        super(GalleryPhotoListTest, self).setUp()
+        self.photo = Photo(title='list test', title_slug='list-test')
+        self.photo.image.save(os.path.basename(PORTRAIT_IMAGE_PATH),
+                              ContentFile(open(PORTRAIT_IMAGE_PATH, 'rb').read()))
+        self.photo.save()
+        self.gallery = Gallery.objects.create(title='list test', title_slug='list-test')
+        self.gallery.photos.add(self.photo)
+        Gallery.objects.clear_photo_lists([self.gallery.pk])
+        self.key = photo_list_key(self.gallery.pk, 'test')
+
+    def tearDown(self):
+        self.gallery.delete()
+        self.photo.delete()
+        super(GalleryPhotoListTest, self).tearDown()
+
+    def test_uncached_size(self):
+        lists = Gallery.objects.photo_lists([self.gallery.pk], 'test')
+        self.assertEqual([p['title'] for p in lists[self.gallery.pk]], ['list test'])
+        # the size was only rendered while building the list
+        self.failUnless(cache.get(self.key) is None)
+
+    def test_cached(self):
+        self.photo.create_size(self.s)
+        lists = Gallery.objects.photo_lists([self.gallery.pk], 'test')
+        self.assertEqual(lists[self.gallery.pk], [{'url': self.photo.get_test_url(), 'title': 'list test'}])
+        self.assertEqual(cache.get(self.key), lists[self.gallery.pk])
+        self.photo.title = 'renamed'
+        self.photo.save()
+        self.failUnless(cache.get(self.key) is None)
+
+    def test_size_change(self):
+        self.photo.create_size(self.s)
+        Gallery.objects.photo_lists([self.gallery.pk], 'test')
+        self.s.width = 50
+        self.s.save()
+        self.failUnless(cache.get(photo_list_key(self.gallery.pk, 'test')) is None)
+
+
+class GalleryUploadTest(TestCase):
+    def test_process_zipfile(self):
+        buf = StringIO()
+        archive = zipfile.ZipFile(buf, 'w')
+        archive.write(LANDSCAPE_IMAGE_PATH, 'landscape.jpg')
+        archive.write(PORTRAIT_IMAGE_PATH, 'portrait.jpg')
+        archive.writestr('broken.jpg', 'not an image')
+        archive.close()
+        Photo.objects.create(title='upload test 1', title_slug='upload-test-1',
+                             image=PHOTOLOGUE_DIR + '/photos/taken.jpg')
+        upload = GalleryUpload(title='upload test')
+        upload.zip_file.save('upload_test.zip', ContentFile(buf.getvalue()), save=False)
+        gallery = upload.save()
+        photos = gallery.photos.order_by('title_slug')
+        self.assertEquals([p.title_slug for p in photos],
+                          ['upload-test-2', 'upload-test-3'])
+        progress = cache.get(upload.progress_key())
+        self.assertEquals((progress['total'], progress['processed'], progress['added']), (3, 3, 2))
+        self.failUnless(progress['done'])
+        for photo in photos:
+            photo.delete()
+
+    def test_progress_key(self):
+        first, second = GalleryUpload(title='same title'), GalleryUpload(title='same title')
+        first.progress_id, second.progress_id = 'a1', 'b2'
+        self.assertNotEqual(first.progress_key(), second.progress_key())
+        self.assertEqual(upload_progress_key('a1 !'), first.progress_key())
@@ -18,7 +18,8 @@
 # pass the -t TAG or --stop-tag TAG argument, or as
 #    tags = EXIF.process_file(f, stop_tag='TAG')
 #
-# where TAG is a valid tag name, ex 'DateTimeOriginal'
+# where TAG is a valid tag name, ex 'DateTimeOriginal', or a list of
+# tag names, in which case processing stops once all of them are retrieved
 #
 # These 2 are useful when you are retrieving a large list of images
 #
@@ -83,6 +84,12 @@
 #
 
 
+import mmap
+import struct
+
+# struct formats for the integer sizes found in EXIF headers
+STRUCT_FORMATS = {1: 'B', 2: 'H', 4: 'L', 8: 'Q'}
+
 # Don't throw an exception when given an out of range character.
 def make_string(seq):
     str = ''
@@ -1237,23 +1244,37 @@ class IFD_Tag:
                                         self.field_offset)
 
 # class that handles an EXIF header
+# If data is given it must hold the EXIF information starting at offset, all
+# reads are then served from it instead of seeking around the file.
 class EXIF_header:
-    def __init__(self, file, endian, offset, fake_exif, strict, debug=0):
+    def __init__(self, file, endian, offset, fake_exif, strict, debug=0, data=None):
         self.file = file
+        self.data = data
         self.endian = endian
         self.offset = offset
+        # offset of data in the file, self.offset may be moved by MakerNotes
+        self.data_offset = offset
         self.fake_exif = fake_exif
         self.strict = strict
         self.debug = debug
         self.tags = {}
+        # tags still to be found before processing can stop early
+        self.stop_tags = set()
+        self.stopped = False
 
     # convert slice to integer, based on sign and endian flags
     # usually this offset is assumed to be relative to the beginning of the
     # start of the EXIF information.  For some cameras that use relative tags,
     # this offset may be relative to some other starting point.
     def s2n(self, offset, length, signed=0):
-        self.file.seek(self.offset+offset)
-        slice=self.file.read(length)
+        fmt = STRUCT_FORMATS.get(length)
+        if fmt and self.data is not None:
+            pos = self.offset-self.data_offset+offset
+            if 0 <= pos <= len(self.data)-length:
+                if signed:
+                    fmt = fmt.lower()
+                return struct.unpack_from(self.byte_order()+fmt, self.data, pos)[0]
+        slice=self.read(offset, length)
         if self.endian == 'I':
             val=s2n_intel(slice)
         else:
@@ -1267,6 +1288,9 @@ class EXIF_header:
 
     # convert offset to string
     def n2s(self, offset, length):
+        fmt = STRUCT_FORMATS.get(length)
+        if fmt and 0 <= offset < 1L << (8*length):
+            return struct.pack(self.byte_order()+fmt, offset)
         s = ''
         for dummy in range(length):
             if self.endian == 'I':
@@ -1276,6 +1300,25 @@ class EXIF_header:
             offset = offset >> 8
         return s
 
+    # struct byte order character for the current endian flag
+    def byte_order(self):
+        if self.endian == 'I':
+            return '<'
+        return '>'
+
+    # read length bytes at offset from the start of the EXIF information
+    def read(self, offset, length):
+        if self.data is not None:
+            pos = self.offset-self.data_offset+offset
+            if 0 <= pos <= len(self.data)-length:
+                return self.data[pos:pos+length]
+            # MakerNotes may point outside the EXIF segment, read those from
+            # the file itself
+        if self.offset+offset < 0:
+            return ''
+        self.file.seek(self.offset+offset)
+        return self.file.read(length)
+
     # return first IFD
     def first_IFD(self):
         return self.s2n(4, 4)
@@ -1349,8 +1392,7 @@ class EXIF_header:
                     # XXX investigate
                     # sometimes gets too big to fit in int value
                     if count != 0 and count < (2**31):
-                        self.file.seek(self.offset + offset)
-                        values = self.file.read(count)
+                        values = self.read(offset, count)
                         #print values
                         # Drop any garbage after a null.
                         values = values.split('\x00', 1)[0]
@@ -1412,7 +1454,11 @@ class EXIF_header:
                     print ' debug:   %s: %s' % (tag_name,
                                                 repr(self.tags[ifd_name + ' ' + tag_name]))
 
-            if tag_name == stop_tag:
+            if tag_name in self.stop_tags:
+                self.stop_tags.discard(tag_name)
+                if not self.stop_tags:
+                    self.stopped = True
+            if self.stopped or tag_name == stop_tag:
                 break
 
     # extract uncompressed TIFF thumbnail (like pulling teeth)
@@ -1426,8 +1472,7 @@ class EXIF_header:
         else:
             tiff = 'II*\x00\x08\x00\x00\x00'
         # ... plus thumbnail IFD data plus a null "next IFD" pointer
-        self.file.seek(self.offset+thumb_ifd)
-        tiff += self.file.read(entries*12+2)+'\x00\x00\x00\x00'
+        tiff += self.read(thumb_ifd, entries*12+2)+'\x00\x00\x00\x00'
 
         # fix up large value offset pointers into data area
         for i in range(entries):
@@ -1454,8 +1499,7 @@ class EXIF_header:
                     strip_off = newoff
                     strip_len = 4
                 # get original data and store it
-                self.file.seek(self.offset + oldoff)
-                tiff += self.file.read(count * typelen)
+                tiff += self.read(oldoff, count * typelen)
 
         # add pixel strips and update strip offset info
         old_offsets = self.tags['Thumbnail StripOffsets'].values
@@ -1466,8 +1510,7 @@ class EXIF_header:
             tiff = tiff[:strip_off] + offset + tiff[strip_off + strip_len:]
             strip_off += strip_len
             # add pixel strip to end
-            self.file.seek(self.offset + old_offsets[i])
-            tiff += self.file.read(old_counts[i])
+            tiff += self.read(old_offsets[i], old_counts[i])
 
         self.tags['TIFFThumbnail'] = tiff
 
@@ -1595,7 +1638,13 @@ class EXIF_header:
 # process an image file (expects an open file object)
 # this is the function that has to deal with all the arbitrary nasty bits
 # of the EXIF standard
-def process_file(f, stop_tag='UNDEF', details=True, strict=False, debug=False):
+# stop_tag may be a single tag name or a list of them, processing stops as
+# soon as every one of them has been retrieved
+#
+# With buffered=True the whole EXIF segment is read in one go (TIFF files are
+# memory mapped) and tags are decoded from that buffer, otherwise every value
+# is read from the file as it is needed
+def process_file(f, stop_tag='UNDEF', details=True, strict=False, debug=False, buffered=True):
     # yah it's cheesy...
     global detailed
     detailed = details
@@ -1611,6 +1660,7 @@ def process_file(f, stop_tag='UNDEF', details=True, strict=False, debug=False):
         endian = f.read(1)
         f.read(1)
         offset = 0
+        length = None
     elif data[0:2] == '\xFF\xD8':
         # it's a JPEG file
         while data[2] == '\xFF' and data[6:10] in ('JFIF', 'JFXX', 'OLYM', 'Phot'):
@@ -1623,6 +1673,8 @@ def process_file(f, stop_tag='UNDEF', details=True, strict=False, debug=False):
             # detected EXIF header
             offset = f.tell()
             endian = f.read(1)
+            # segment length less its own two bytes and 'Exif\x00\x00'
+            length = ord(data[4])*256+ord(data[5])-8
         else:
             # no EXIF information
             return {}
@@ -1633,7 +1685,22 @@ def process_file(f, stop_tag='UNDEF', details=True, strict=False, debug=False):
     # deal with the EXIF info we found
     if debug:
         print {'I': 'Intel', 'M': 'Motorola'}[endian], 'format'
-    hdr = EXIF_header(f, endian, offset, fake_exif, strict, debug)
+    exif_data = None
+    if buffered:
+        exif_data = read_exif_data(f, offset, length)
+    hdr = EXIF_header(f, endian, offset, fake_exif, strict, debug, exif_data)
+    if isinstance(stop_tag, basestring):
+        stop_tag = [stop_tag]
+    hdr.stop_tags = set(stop_tag) - set(['UNDEF'])
+    try:
+        return dump_header(hdr, debug)
+    finally:
+        # don't leave TIFF files mapped
+        if isinstance(exif_data, mmap.mmap):
+            exif_data.close()
+
+# decode the IFDs, thumbnails and MakerNote of a header, returns its tags
+def dump_header(hdr, debug=False):
     ifd_list = hdr.list_IFDs()
     ctr = 0
     for i in ifd_list:
@@ -1646,13 +1713,17 @@ def process_file(f, stop_tag='UNDEF', details=True, strict=False, debug=False):
             IFD_name = 'IFD %d' % ctr
         if debug:
             print ' IFD %d (%s) at offset %d:' % (ctr, IFD_name, i)
-        hdr.dump_IFD(i, IFD_name, stop_tag=stop_tag)
+        hdr.dump_IFD(i, IFD_name)
+        if hdr.stopped:
+            return hdr.tags
         # EXIF IFD
         exif_off = hdr.tags.get(IFD_name+' ExifOffset')
         if exif_off:
             if debug:
                 print ' EXIF SubIFD at offset %d:' % exif_off.values[0]
-            hdr.dump_IFD(exif_off.values[0], 'EXIF', stop_tag=stop_tag)
+            hdr.dump_IFD(exif_off.values[0], 'EXIF')
+            if hdr.stopped:
+                return hdr.tags
             # Interoperability IFD contained in EXIF IFD
             intr_off = hdr.tags.get('EXIF SubIFD InteroperabilityOffset')
             if intr_off:
@@ -1660,13 +1731,17 @@ def process_file(f, stop_tag='UNDEF', details=True, strict=False, debug=False):
                     print ' EXIF Interoperability SubSubIFD at offset %d:' \
                           % intr_off.values[0]
                 hdr.dump_IFD(intr_off.values[0], 'EXIF Interoperability',
-                             dict=INTR_TAGS, stop_tag=stop_tag)
+                             dict=INTR_TAGS)
+                if hdr.stopped:
+                    return hdr.tags
         # GPS IFD
         gps_off = hdr.tags.get(IFD_name+' GPSInfo')
         if gps_off:
             if debug:
                 print ' GPS SubIFD at offset %d:' % gps_off.values[0]
-            hdr.dump_IFD(gps_off.values[0], 'GPS', dict=GPS_TAGS, stop_tag=stop_tag)
+            hdr.dump_IFD(gps_off.values[0], 'GPS', dict=GPS_TAGS)
+            if hdr.stopped:
+                return hdr.tags
         ctr += 1
 
     # extract uncompressed TIFF thumbnail
@@ -1677,9 +1752,8 @@ def process_file(f, stop_tag='UNDEF', details=True, strict=False, debug=False):
     # JPEG thumbnail (thankfully the JPEG data is stored as a unit)
     thumb_off = hdr.tags.get('Thumbnail JPEGInterchangeFormat')
     if thumb_off:
-        f.seek(offset+thumb_off.values[0])
         size = hdr.tags['Thumbnail JPEGInterchangeFormatLength'].values[0]
-        hdr.tags['JPEGThumbnail'] = f.read(size)
+        hdr.tags['JPEGThumbnail'] = hdr.read(thumb_off.values[0], size)
 
     # deal with MakerNote contained in EXIF IFD
     # (Some apps use MakerNote tags but do not use a format for which we
@@ -1692,12 +1766,24 @@ def process_file(f, stop_tag='UNDEF', details=True, strict=False, debug=False):
     if 'JPEGThumbnail' not in hdr.tags:
         thumb_off=hdr.tags.get('MakerNote JPEGThumbnail')
         if thumb_off:
-            f.seek(offset+thumb_off.values[0])
-            hdr.tags['JPEGThumbnail']=file.read(thumb_off.field_length)
+            hdr.tags['JPEGThumbnail']=hdr.read(thumb_off.values[0], thumb_off.field_length)
 
     return hdr.tags
 
 
+# read the EXIF information starting at offset into a buffer, length is None
+# for TIFF files where it spans the whole file
+def read_exif_data(f, offset, length):
+    if length is None:
+        try:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (AttributeError, EnvironmentError, ValueError):
+            pass
+    f.seek(offset)
+    if length is None:
+        return f.read()
+    return f.read(length)
+
 # show command line usage
 def usage(exit_status):
     msg = 'Usage: EXIF.py [OPTIONS] file1 [file2 ...]\n'
@@ -0,0 +1,45 @@
+""" Cache of prepared image layers shared by the image effects. """
+import threading
+
+class LayerCache(object):
+    """Keeps the most recently used prepared layers, such as watermarks and
+    reflection masks.
+
+    Layers are built by calling the function passed to get on a miss, once
+    maxsize layers are held the least recently used one is dropped.
+    """
+    def __init__(self, maxsize=16):
+        self.maxsize = maxsize
+        self.layers = {}
+        self.order = []
+        self.lock = threading.Lock()
+
+    def get(self, key, build):
+        self.lock.acquire()
+        try:
+            if key in self.layers:
+                self.order.remove(key)
+                self.order.append(key)
+                return self.layers[key]
+        finally:
+            self.lock.release()
+        layer = build()
+        if self.maxsize > 0:
+            self.lock.acquire()
+            try:
+                if key not in self.layers:
+                    self.order.append(key)
+                self.layers[key] = layer
+                while len(self.order) > self.maxsize:
+                    del self.layers[self.order.pop(0)]
+            finally:
+                self.lock.release()
+        return layer
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.layers.clear()
+            del self.order[:]
+        finally:
+            self.lock.release()
@@ -40,6 +40,25 @@ except ImportError:
     except ImportError:
         raise ImportError("The Python Imaging Library was not found.")
 
+from cache import LayerCache
+
+# Gradient masks already computed, keyed by image size, amount and opacity
+masks = LayerCache(16)
+
+
+def gradient_mask(size, amount, opacity):
+    """ Returns the alpha mask blending the reflection of an image of the
+    given size into the background, only as tall as the reflection itself.
+    """
+    start = int(255 - (255 * opacity)) # The start of our gradient
+    reflection_height = int(size[1] * amount)
+    # from the start opacity on the first row to the background on the last
+    span = float(max(reflection_height - 1, 1))
+    values = [int(start + (255 - start) * row / span) for row in range(reflection_height)]
+    mask = Image.new('L', (1, reflection_height))
+    mask.putdata(values)
+    return mask.resize((size[0], reflection_height))
+
 
 def add_reflection(im, bgcolor="#00000", amount=0.4, opacity=0.6):
     """ Returns the supplied PIL Image (im) with a reflection effect
@@ -54,39 +73,23 @@ def add_reflection(im, bgcolor="#00000", amount=0.4, opacity=0.6):
     """
     # convert bgcolor string to rgb value
     background_color = ImageColor.getrgb(bgcolor)
-
-    # copy orignial image and flip the orientation
-    reflection = im.copy().transpose(Image.FLIP_TOP_BOTTOM)
-
-    # create a new image filled with the bgcolor the same size
-    background = Image.new("RGB", im.size, background_color)
-
-    # calculate our alpha mask
-    start = int(255 - (255 * opacity)) # The start of our gradient
-    steps = int(255 * amount) # the number of intermedite values
-    increment = (255 - start) / float(steps)
-    mask = Image.new('L', (1, 255))
-    for y in range(255):
-        if y < steps:
-            val = int(y * increment + start)
-        else:
-            val = 255
-        mask.putpixel((0, y), val)
-    alpha_mask = mask.resize(im.size)
-
-    # merge the reflection onto our background color using the alpha mask
-    reflection = Image.composite(background, reflection, alpha_mask)
-
-    # crop the reflection
-    reflection_height = int(im.size[1] * amount)
-    reflection = reflection.crop((0, 0, im.size[0], reflection_height))
+    width, height = im.size
+    reflection_height = int(height * amount)
 
     # create new image sized to hold both the original image and the reflection
-    composite = Image.new("RGB", (im.size[0], im.size[1]+reflection_height), background_color)
-
-    # paste the orignal image and the reflection into the composite image
+    composite = Image.new("RGB", (width, height + reflection_height), background_color)
     composite.paste(im, (0, 0))
-    composite.paste(reflection, (0, im.size[1]))
+    if reflection_height < 1:
+        return composite
+
+    # only the strip of the original that ends up reflected is flipped
+    reflection = im.crop((0, height - reflection_height, width, height))
+    composite.paste(reflection.transpose(Image.FLIP_TOP_BOTTOM), (0, height))
+
+    # fade the reflection into the background color through the alpha mask
+    mask = masks.get((im.size, amount, opacity),
+                     lambda: gradient_mask(im.size, amount, opacity))
+    composite.paste(background_color, (0, height, width, height + reflection_height), mask)
 
     # return the image complete with reflection effect
     return composite
@@ -27,38 +27,64 @@ def reduce_opacity(im, opacity):
     im.putalpha(alpha)
     return im
 
-def apply_watermark(im, mark, position, opacity=1):
-    """Adds a watermark to an image."""
+def tile(mark, size):
+    """Returns a layer of the given size covered with copies of mark.
+
+    The sheet is grown by doubling, so it takes a handful of pastes rather
+    than one per cell.
+    """
+    layer = Image.new('RGBA', size, (0,0,0,0))
+    layer.paste(mark, (0, 0))
+    w, h = mark.size
+    while w < size[0]:
+        layer.paste(layer.crop((0, 0, w, h)), (w, 0))
+        w *= 2
+    while h < size[1]:
+        layer.paste(layer.crop((0, 0, size[0], h)), (0, h))
+        h *= 2
+    return layer
+
+def prepare_layer(mark, size, position, opacity=1):
+    """Returns a transparent layer of the given size with the watermark
+    drawn in it, ready to be composited by apply_layer."""
     if opacity < 1:
         mark = reduce_opacity(mark, opacity)
-    if im.mode != 'RGBA':
-        im = im.convert('RGBA')
-    # create a transparent layer the size of the image and draw the
-    # watermark in that layer.
-    layer = Image.new('RGBA', im.size, (0,0,0,0))
+    elif mark.mode != 'RGBA':
+        mark = mark.convert('RGBA')
     if position == 'tile':
-        for y in range(0, im.size[1], mark.size[1]):
-            for x in range(0, im.size[0], mark.size[0]):
-                layer.paste(mark, (x, y))
-    elif position == 'scale':
+        return tile(mark, size)
+    layer = Image.new('RGBA', size, (0,0,0,0))
+    if position == 'scale':
         # scale, but preserve the aspect ratio
         ratio = min(
-            float(im.size[0]) / mark.size[0], float(im.size[1]) / mark.size[1])
+            float(size[0]) / mark.size[0], float(size[1]) / mark.size[1])
         w = int(mark.size[0] * ratio)
         h = int(mark.size[1] * ratio)
         mark = mark.resize((w, h))
-        layer.paste(mark, ((im.size[0] - w) / 2, (im.size[1] - h) / 2))
+        layer.paste(mark, ((size[0] - w) / 2, (size[1] - h) / 2))
     else:
         layer.paste(mark, position)
-    # composite the watermark with the layer
-    return Image.composite(layer, im, layer)
+    return layer
+
+def apply_layer(im, layer):
+    """Composites a layer made by prepare_layer with an image."""
+    if im.mode != 'RGBA':
+        im = im.convert('RGBA')
+    else:
+        im = im.copy()
+    im.paste(layer, (0, 0), layer)
+    return im
+
+def apply_watermark(im, mark, position, opacity=1):
+    """Adds a watermark to an image."""
+    return apply_layer(im, prepare_layer(mark, im.size, position, opacity))
 
 def test():
     im = Image.open('test.png')
     mark = Image.open('overlay.png')
-    watermark(im, mark, 'tile', 0.5).show()
-    watermark(im, mark, 'scale', 1.0).show()
-    watermark(im, mark, (100, 100), 0.5).show()
+    apply_watermark(im, mark, 'tile', 0.5).show()
+    apply_watermark(im, mark, 'scale', 1.0).show()
+    apply_watermark(im, mark, (100, 100), 0.5).show()
 
 if __name__ == '__main__':
     test()
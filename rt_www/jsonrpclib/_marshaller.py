@@ -1,13 +1,14 @@
-from _errors import ResponseError
-import urlparse, simplejson, re
+from _errors import ResponseError, Fault
+import urlparse, simplejson
 
 class JSONUnmarshaller:
     def __init__(self):
         self._stack = [] #Arg stack
-        self._data = [] #Raw text
+        self._data = [] #Raw text, as fed
         self._methodname = None
-        self._encoding = 'uft-8'
-        self._decoder = simplejson.JSONDecoder()
+        self._encoding = 'utf-8'
+        # raw newlines inside strings are kept rather than rejected
+        self._decoder = simplejson.JSONDecoder(encoding=self._encoding, strict=False)
         self._type = ''
         self._id = None
         self._obj = None
@@ -18,13 +19,26 @@ class JSONUnmarshaller:
             raise Fault(**self._stack[0])
         return tuple(self._stack)
     def end(self):
-        self._data = re.sub('[\r\n]+', '', ''.join(self._data))
+        """ Decodes the fed text.  A body fed in one piece, as the middleware does, is decoded without a copy """
+        if len(self._data) == 1:
+            self._data = self._data[0]
+        else:
+            self._data = ''.join(self._data)
         if len(self._data) != 0:
             self._obj = self._decoder.decode(self._data)
+            if isinstance(self._obj, list):
+                """ A batch of calls, each checked by the caller """
+                self._type = 'batch'
+                self._stack = self._obj
+                return
+            if not isinstance(self._obj, dict):
+                self._stack = [ {'faultCode':'103', 'faultString':'Malformed request, expected an object or an array'} ]
+                self._type = 'fault'
+                return
             try:
                 self._stack = self._obj['params']
             except KeyError:
-                self._stack = [ Fault('103', 'Malformed request missing params keyword') ]
+                self._stack = [ {'faultCode':'103', 'faultString':'Malformed request missing params keyword'} ]
                 self._type = 'fault'
             try:
                 self._id = self._obj['id']
@@ -37,6 +51,14 @@ class JSONUnmarshaller:
             return self._id
         else:
             return '0'
+    def is_batch(self):
+        return self._type == 'batch'
+    def get_method(self):
+        """ The method named in a POST body, or None """
+        try:
+            return self._obj['method']
+        except (KeyError, TypeError):
+            return None
     def get_args(self):
         return tuple(self._stack)
     def getmethodname(self, url):
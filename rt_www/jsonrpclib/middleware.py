@@ -1,7 +1,11 @@
 from django.conf import settings
 from django.http import HttpResponse
 from rt_www import jsonrpclib
-import os, re, sys
+from django.db import connection
+import os, sys, threading, Queue
+
+# Number of threads running the calls of a batch that are marked concurrent_safe
+JSONRPC_BATCH_THREADS = getattr(settings, 'JSONRPC_BATCH_THREADS', 4)
 class JSONRPCMiddleware:
     """
         This piece of middleware implements the Non-Standard JSON RPC standard for the django framework
@@ -28,13 +32,19 @@ class JSONRPCMiddleware:
                 #stuff
         service = Service()
 
-        Upon instantiation this middleware goes through each directory and attaches each method for the service object
-        to itself like: self._service__module__method(self, arg)
-        so the request /services/module/ with the method to execute in the POST is transformed into this call
+        Upon instantiation this middleware goes through each directory and builds a route table mapping
+        (service, module, method) to the bound method of the service object, so the request /services/module/
+        with the method to execute in the POST is a single dictionary lookup.
 
         Finally we need a couple access requirements.  If the method has a .login_required = True attribute then
         the user must be logged to use the remote method
         .staff_required => .login_required and also means the user must have is_staff == True
+
+        Batches --
+
+        The POST body may also be an array of call objects.  The calls are run in order and the response is an
+        array holding the result or error of each call under its id.  Consecutive calls to methods with a
+        .concurrent_safe = True attribute are run at the same time, in up to JSONRPC_BATCH_THREADS threads.
     """
     def __init__(self):
         try:
@@ -45,79 +55,159 @@ class JSONRPCMiddleware:
         except AttributeError:
             try:
                 self.services, self.adminservices = getattr(settings, 'SERVICES'), getattr(settings, 'ADMINSERVICES')
-                sys.path += [self.services + '/../', self.adminservice + '/../']
+                sys.path += [self.services + '/../', self.adminservices + '/../']
             except AttributeError:
                 raise Exception('Either ROOT or SERVICES and ADMINSERVICES must be declared in your settings.py')
-        self.__modules = []
+        self.routes = {}
+        self.paths = {}
+        self.concurrent = set()
         self.__load_modules(self.services, 'services')
         self.__load_modules(self.adminservices, 'adminservices')
 
     def __load_modules(self, path, type):
         """ load all the submodules from each """
-
-        mod_names = [ re.sub('.py', '', f ) for f in os.listdir(path) if re.search('^[^_].*?\.py$', f) ]
-        for name in mod_names:
+        for f in os.listdir(path):
+            if f.startswith('_') or not f.endswith('.py'):
+                continue
+            name = f[:-3]
             try:
                 m = __import__('%s.%s' %(type, name), globals(), locals(), ['service'])
-                globals()['service'] = getattr(m, 'service')
-                for m in dir(service):
-                    method = getattr(service, m)
-                    if callable(method):
-                        self.__dict__['_%s_%s_%s' %(type, name, m)] = method
-                self.__modules.append('%s_%s' %( type, name))
+                self.register(type, name, getattr(m, 'service'))
             except AttributeError:
                 continue
             except ImportError:
                 continue
 
-
-    def __isrpcpath(self, requestpath):
-        root = '_'.join([ p for p in requestpath.split('/') if p != '' ])
-        return root in self.__modules
-    def __getmethod(self, funcpath):
+    def register(self, type, name, service):
+        """
+            Adds a route for each public method of service, with its access requirements worked out once.
+            Methods with a login_required or staff_required attribute get the request as their last argument
+        """
+        for attr in dir(service):
+            if attr.startswith('_'):
+                continue
+            method = getattr(service, attr)
+            if not callable(method):
+                continue
+            login = getattr(method, 'login_required', None)
+            staff = getattr(method, 'staff_required', None)
+            pass_request = login is not None or staff is not None
+            staff = bool(staff) or type == 'adminservices'
+            self.routes[(type, name, attr)] = (method, pass_request, bool(login) or staff, staff)
+            if getattr(method, 'concurrent_safe', False):
+                self.concurrent.add((type, name, attr))
+        self.paths['/%s/%s/' % (type, name)] = self.paths['/%s/%s' % (type, name)] = (type, name)
+
+    def resolve_path(self, path):
+        """ The (service, module) a request path is routed to, or None """
         try:
-            return getattr(self, '_%s' % funcpath)
-        except AttributeError:
+            return self.paths[path]
+        except KeyError:
+            parts = tuple([ p for p in path.split('/') if p != '' ])
+            if len(parts) == 2 and '/%s/%s/' % parts in self.paths:
+                return parts
             return None
 
+    def dispatch(self, request, module, methodname, args):
+        """ Calls the routed method and returns the response struct, less the id """
+        try:
+            func, pass_request, login, staff = self.routes[module + (methodname,)]
+        except KeyError:
+            return {'version':'1.1', 'error':{'name':'JSONRPCError', 'code':jsonrpclib.FAILURE,
+                                              'message':'No such method %s' % methodname}}
+        ret_val = {'version':'1.1'}
+        if login and not (request.user.is_authenticated() and (request.user.is_staff or not staff)):
+            ret_val['error'] = {'name':'JSONRPCError', 'code':jsonrpclib.FAILURE, 'message':'Permission Denied'}
+            return ret_val
+        if pass_request:
+            args = tuple(args) + (request,)
+        try:
+            ret_val['result'] = func(*args)
+        except Exception, e:
+            ret_val['error'] = {'name':'JSONRPCError', 'code':jsonrpclib.FAILURE, 'message':'%s' % e}
+        return ret_val
+
+    def call(self, request, module, call):
+        """ Runs one call of a batch, any failure is reported in its own response """
+        if not isinstance(call, dict):
+            return {'version':'1.1', 'id':None, 'error':{'name':'JSONRPCError', 'code':'103',
+                    'message':'Malformed request, expected an object'}}
+        if not isinstance(call.get('params'), list):
+            return {'version':'1.1', 'id':call.get('id'), 'error':{'name':'JSONRPCError', 'code':'103',
+                    'message':'Malformed request missing params keyword'}}
+        ret_val = self.dispatch(request, module, call.get('method'), call['params'])
+        ret_val['id'] = call.get('id')
+        return ret_val
+
+    def call_concurrently(self, request, module, calls):
+        """ Runs calls in a pool of threads, returns their responses in order """
+        if len(calls) == 1:
+            return [self.call(request, module, calls[0])]
+        responses = [None] * len(calls)
+        pending = Queue.Queue()
+        for i, call in enumerate(calls):
+            pending.put((i, call))
+        def work():
+            try:
+                while True:
+                    try:
+                        i, call = pending.get_nowait()
+                    except Queue.Empty:
+                        return
+                    responses[i] = self.call(request, module, call)
+            finally:
+                # each thread has its own database connection
+                connection.close()
+        threads = [ threading.Thread(target=work) for i in range(min(JSONRPC_BATCH_THREADS, len(calls))) ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return responses
+
+    def dispatch_batch(self, request, module, calls):
+        """ Runs a batch of calls, returns the list of their responses """
+        # load the user before any thread needs it
+        request.user.is_authenticated()
+        responses, run = [], []
+        for call in calls:
+            if isinstance(call, dict) and module + (call.get('method'),) in self.concurrent:
+                run.append(call)
+                continue
+            if run:
+                responses.extend(self.call_concurrently(request, module, run))
+                run = []
+            responses.append(self.call(request, module, call))
+        if run:
+            responses.extend(self.call_concurrently(request, module, run))
+        return responses
+
     def process_request(self, request):
         """
         This takes a post request of the form
         /services/<module>/ and executes the attached method.
         anything in /adminservices/ requires staff status
         """
-        if request.method == 'POST' and self.__isrpcpath(request.path):
-            parser, unmarshaller = jsonrpclib.getparser()
+        if request.method != 'POST':
+            return None
+        module = self.resolve_path(request.path)
+        if module is None:
+            return None
+        parser, unmarshaller = jsonrpclib.getparser()
+        try:
             parser.feed(request.raw_post_data)
             parser.close()
-
-            args, id, funcpath = unmarshaller.close(), unmarshaller.get_id(), unmarshaller.getmethodname(request.path)
-            func = self.__getmethod(funcpath)
-
-            ret_val = { 'version':'1.1', 'id':id }
-
-            try:
-                if [ p for p in request.path.split('/') if p != ''][0] == 'adminservices':
-                    if not ( request.user.is_authenticated() and request.user.is_staff ):
-                        ret_val['error'] = {'name':'JSONRPCError', 'code':jsonrpclib.FAILURE, 'message':'Permission Denied'}
-                try:
-                    lrequired = getattr(func, 'login_required')
-                    if lrequired and not request.user.is_authenticated():
-                        ret_val['error'] = {'name':'JSONRPCError', 'code':jsonrpclib.FAILURE, 'message':'Permission Denied'}
-                    args = tuple([ a for a in args ] + [ request ])
-                except AttributeError:
-                    pass
-
-                try:
-                    isstaff = getattr(func, 'staff_required')
-                    if isstaff and not ( request.user.is_authenticated() and request.user.is_staff ):
-                        ret_val['error'] = {'name':'JSONRPCError', 'code':jsonrpclib.FAILURE, 'message':'Permission Denied'}
-                    args = tuple([ a for a in args ] + [ request ])
-                except AttributeError:
-                    pass
-
-                ret_val['result'] = func(*args)
-            except Exception, e:
-                ret_val['error'] = {'name':'JSONRPCError', 'code':jsonrpclib.FAILURE, 'message':'%s' % e}
-
+            args = unmarshaller.close()
+        except ValueError, e:
+            ret_val = {'version':'1.1', 'id':None, 'error':{'name':'JSONRPCError', 'code':'102', 'message':'Parse error: %s' % e}}
+            return HttpResponse(jsonrpclib.dumps(ret_val), mimetype='application/javascript')
+        except jsonrpclib.Fault, e:
+            ret_val = {'version':'1.1', 'id':unmarshaller.get_id(), 'error':{'name':'JSONRPCError', 'code':e.faultCode, 'message':e.faultString}}
             return HttpResponse(jsonrpclib.dumps(ret_val), mimetype='application/javascript')
+
+        if unmarshaller.is_batch():
+            responses = self.dispatch_batch(request, module, args)
+            return HttpResponse(jsonrpclib.dumps(responses), mimetype='application/javascript')
+        ret_val = self.dispatch(request, module, unmarshaller.get_method(), args)
+        ret_val['id'] = unmarshaller.get_id()
+        return HttpResponse(jsonrpclib.dumps(ret_val), mimetype='application/javascript')
@@ -0,0 +1,110 @@
+import unittest
+from django.utils import simplejson
+from rt_www import jsonrpclib
+from rt_www.jsonrpclib.middleware import JSONRPCMiddleware
+
+
+class BatchService:
+    def echo(self, value):
+        return value
+
+    def read(self, value):
+        return value
+    read.concurrent_safe = True
+
+    def fail(self):
+        raise ValueError('failed')
+
+
+class BatchUser:
+    def is_authenticated(self):
+        return False
+
+
+class BatchRequest:
+    method = 'POST'
+    path = '/services/batch/'
+
+    def __init__(self, body):
+        self.raw_post_data = body
+        self.user = BatchUser()
+
+
+class BatchMiddleware(JSONRPCMiddleware):
+    def __init__(self):
+        JSONRPCMiddleware.__init__(self)
+        self.register('services', 'batch', BatchService())
+
+
+class JSONRPCBatchTest(unittest.TestCase):
+    def post(self, body):
+        response = BatchMiddleware().process_request(BatchRequest(body))
+        return simplejson.loads(response.content)
+
+    def test_concurrent_routes(self):
+        middleware = BatchMiddleware()
+        self.failUnless(('services', 'batch', 'read') in middleware.concurrent)
+        self.failIf(('services', 'batch', 'echo') in middleware.concurrent)
+        # the read-only methods of the loaded services are marked
+        self.failUnless(('adminservices', 'survey', 'get_type_mapping') in middleware.concurrent)
+        self.failIf(('adminservices', 'survey', 'save_question') in middleware.concurrent)
+
+    def test_order(self):
+        calls = [{'method': 'echo', 'params': [1], 'id': 1},
+                 {'method': 'read', 'params': [2], 'id': 2},
+                 {'method': 'read', 'params': [3], 'id': 3},
+                 {'method': 'echo', 'params': [4], 'id': 4},
+                 {'method': 'read', 'params': [5], 'id': 5}]
+        responses = self.post(simplejson.dumps(calls))
+        self.assertEquals([(r['id'], r['result']) for r in responses],
+                          [(1, 1), (2, 2), (3, 3), (4, 4), (5, 5)])
+
+    def test_errors(self):
+        calls = [{'method': 'fail', 'params': [], 'id': 1},
+                 {'method': 'missing', 'params': [], 'id': 2},
+                 {'method': 'echo', 'id': 3},
+                 'not a call',
+                 {'method': 'echo', 'params': ['ok'], 'id': 5}]
+        responses = self.post(simplejson.dumps(calls))
+        self.assertEquals([r['id'] for r in responses], [1, 2, 3, None, 5])
+        self.assertEquals(responses[0]['error']['message'], 'failed')
+        self.assertEquals(responses[1]['error']['message'], 'No such method missing')
+        self.assertEquals(responses[2]['error']['code'], '103')
+        self.assertEquals(responses[3]['error']['code'], '103')
+        self.assertEquals(responses[4]['result'], 'ok')
+
+    def test_scalar_body(self):
+        for body in ('"text"', '5'):
+            self.assertEquals(self.post(body)['error']['code'], '103')
+
+
+class UnmarshallerTest(unittest.TestCase):
+    def parse(self, *chunks):
+        parser, unmarshaller = jsonrpclib.getparser()
+        for chunk in chunks:
+            parser.feed(chunk)
+        parser.close()
+        return unmarshaller
+
+    def test_encoding(self):
+        unmarshaller = self.parse('{"method": "m", "params": ["caf\xc3\xa9"], "id": 1}')
+        self.assertEquals(unmarshaller.close(), (u'caf\xe9',))
+        self.assertEquals((unmarshaller.get_method(), unmarshaller.get_id()), ('m', 1))
+
+    def test_raw_newlines(self):
+        # raw newlines inside strings are kept, fed in one piece or several
+        self.assertEquals(self.parse('{"params": ["a\nb"]}').close(), (u'a\nb',))
+        self.assertEquals(self.parse('{"params": ', '["a\r\nb"]}').close(), (u'a\r\nb',))
+
+    def test_missing_params(self):
+        unmarshaller = self.parse('{"method": "m", "id": 7}')
+        try:
+            unmarshaller.close()
+        except jsonrpclib.Fault, e:
+            self.assertEquals((e.faultCode, unmarshaller.get_id()), ('103', 7))
+        else:
+            self.fail('no Fault raised')
+
+    def test_parse_error(self):
+        response = BatchMiddleware().process_request(BatchRequest('{"params": ['))
+        self.assertEquals(simplejson.loads(response.content)['error']['code'], '102')
@@ -1,13 +1,26 @@
 from django.contrib import admin
 
-from photogallery.models import Video, Photo, Gallery, PhotoPlace
+from photogallery.models import Video, Photo, Gallery, PhotoPlace, TranscodeJob, PENDING, RUNNING
 
 class VideoAdmin(admin.ModelAdmin):
-    list_display = ('thumb_link', 'title', 'date_uploaded',)
+    list_display = ('thumb_link', 'title', 'date_uploaded', 'transcode_status',)
     list_filter = ('date_uploaded',)
 
 admin.site.register(Video, VideoAdmin)
 
+class TranscodeJobAdmin(admin.ModelAdmin):
+    list_display = ('__unicode__', 'video', 'status', 'attempts', 'date_created', 'date_updated',)
+    list_filter = ('status', 'kind',)
+
+    def changelist_view(self, request, extra_context=None):
+        """ Shows the queue depth in the title """
+        pending = TranscodeJob.objects.filter(status=PENDING).count()
+        running = TranscodeJob.objects.filter(status=RUNNING).count()
+        context = {'title': 'Transcode jobs: %d pending, %d running' % (pending, running)}
+        context.update(extra_context or {})
+        return super(TranscodeJobAdmin, self).changelist_view(request, context)
+admin.site.register(TranscodeJob, TranscodeJobAdmin)
+
 class PhotoAdmin(admin.ModelAdmin):
     list_display = ( 'thumb', 'title', 'photographer', 'gallery',)
     list_filter = ( 'gallery', )
@@ -11,7 +11,7 @@ from django.contrib.auth.models import User
 from django.contrib.admin.views.main import ChangeList
 from django.contrib.admin.models import LogEntry, ADDITION, CHANGE, DELETION
 
-from rt_www.photogallery.models import Gallery, Photo, PhotoPlace
+from rt_www.photogallery.models import Gallery, Photo
 from rt_www.swimmers.models import Swimmer
 
 def index(request):
@@ -54,29 +54,7 @@ def change_gallery(request, add = None, gid = None):
                 gallery = Gallery(title=new_data['title'], creator=user)
                 gallery.save()
 
-            """ First thing we do is clear out any old ordering sitting about """
-            places = PhotoPlace.objects.filter(gallery__id__exact=gallery.id)
-            for p in places:
-                p.delete()
-
-            for d in images_to_disassociate:
-                try:
-                    photo = Photo.objects.get(pk=d)
-                    gallery.photo_set.remove(photo)
-                except Photo.DoesNotExist:
-                    continue
-                except Gallery.DoesNotExist: #This should never happen
-                    continue
-
-            for i, image_id in enumerate(images_to_add):
-                try:
-                    photo = Photo.objects.get(pk=image_id)
-                except Photo.DoesNotExist:
-                    continue
-                gallery.photo_set.add(photo)
-                p = PhotoPlace(gallery=gallery, photo=photo, place=i)
-                p.save()
-            gallery.save()
+            gallery.set_photos(images_to_add, images_to_disassociate)
 
             LogEntry.objects.log_action(request.user.id,
                 ContentType.objects.get_for_model(Gallery).id, gallery.id, str(gallery), CHANGE)
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+from optparse import make_option
+from photogallery.transcoding import TranscodeQueue, VIDEO_TRANSCODE_WORKERS, VIDEO_TRANSCODE_POLL
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--workers', '-w', type='int', dest='workers', default=VIDEO_TRANSCODE_WORKERS, help='Number of jobs run at the same time'),
+        make_option('--poll', '-p', type='int', dest='poll', default=VIDEO_TRANSCODE_POLL, help='Seconds between looks at an idle queue'),
+        make_option('--once', action='store_true', dest='once', help='Exit once the queue is empty, for running from cron'),
+    )
+
+    help = ('Runs the queued video transcode and thumbnail jobs.')
+
+    requires_model_validation = True
+    can_import_settings = True
+
+    def handle(self, *args, **options):
+        queue = TranscodeQueue(options.get('workers'), options.get('poll'))
+        queue.run(options.get('once', False), int(options.get('verbosity', 1)))
@@ -1,6 +1,6 @@
-import os.path, md5, Image, os, subprocess
+import os.path, md5, Image, os, shutil
 
-from django.db import models
+from django.db import models, connection, transaction
 from django.utils.translation import gettext_lazy as _
 from django.contrib.auth.models import User
 from django.conf import settings
@@ -34,11 +34,12 @@ class Video(models.Model):
 
     def save(self):
         """
-            Couple steps in here.  We check to see if the file is an avi file.  If so we convert it to a flv.
-            Second we pull the first frame for a screen capture.
+            Couple steps in here.  We name the converted flv file after the upload and queue a
+            TranscodeJob to convert it, the thumbnail is pulled from the flv by a second job once
+            the transcode is done.
             if thumbfile is set we assume this has already been done
         """
-
+        source = None
         if self.thumbfile == '':
             """ make filename """
             f = open(self.video, 'rb')
@@ -46,14 +47,29 @@ class Video(models.Model):
             f.close()
             m = md5.new()
             m.update(data)
-            nvname = '%s/videos/%s.flv' %( settings.MEDIA_ROOT, m.hexdigest() )
+            source = self.video
+            self.video = '%s/videos/%s.flv' %( settings.MEDIA_ROOT, m.hexdigest() )
             self.thumbfile = '%s/videos/thumbs/%s.png' %( settings.MEDIA_ROOT, m.hexdigest() )
-            ret = subprocess.Popen('/usr/bin/ffmpeg -i %s -acodec mp3 -ar 22050 -ab 32 -f flv -s 320x240 %s; /usr/bin/ffmpeg -y -i %s -vframes 1 -ss 00:00:02 -an -vcodec png -f rawvideo -s 320x240 %s; /usr/bin/flvtool2 -U %s; rm %s' %( self.video, nvname, nvname, self.thumbfile, nvname, self.video), shell=True)
-            self.video = nvname
 
         super(Video, self).save()
+        if source is not None:
+            TranscodeJob.objects.create(video=self, kind=TRANSCODE, source=source, target=self.video)
+
+    def transcode_status(self):
+        """ Status of the latest job for this video """
+        jobs = self.jobs.order_by('-date_created')[:1]
+        if not jobs:
+            return ''
+        return '%s %s' % (jobs[0].get_kind_display(), jobs[0].get_status_display())
+    transcode_status.short_description = _('Transcoding')
 
     def delete(self):
+        # uploads that were never converted are still at their original path
+        for source in self.jobs.filter(kind=TRANSCODE).exclude(status=DONE).values_list('source', flat=True):
+            try:
+                os.unlink(source)
+            except OSError:
+                pass
         try:
             os.unlink(self.video)
             os.unlink(self.thumbfile)
@@ -62,6 +78,82 @@ class Video(models.Model):
             pass
         super(Video, self).delete()
 
+TRANSCODE = 'transcode'
+THUMBNAIL = 'thumbnail'
+JOB_KINDS = (
+    (TRANSCODE, _('Transcode')),
+    (THUMBNAIL, _('Thumbnail')),
+)
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+JOB_STATUSES = (
+    (PENDING, _('Pending')),
+    (RUNNING, _('Running')),
+    (DONE, _('Done')),
+    (FAILED, _('Failed')),
+)
+
+FFMPEG = getattr(settings, 'VIDEO_FFMPEG', '/usr/bin/ffmpeg')
+FLVTOOL2 = getattr(settings, 'VIDEO_FLVTOOL2', '/usr/bin/flvtool2')
+# Number of times a job is run before it is marked as failed
+VIDEO_TRANSCODE_RETRIES = getattr(settings, 'VIDEO_TRANSCODE_RETRIES', 3)
+# Only the end of the command output is kept, ffmpeg is chatty
+VIDEO_TRANSCODE_OUTPUT = getattr(settings, 'VIDEO_TRANSCODE_OUTPUT', 16384)
+
+class TranscodeJob(models.Model):
+    """
+        A conversion queued for a Video.  Jobs are run by the transcode management command,
+        which runs a bounded number of them at a time.
+    """
+    video = models.ForeignKey(Video, related_name='jobs')
+    kind = models.CharField(_('Kind'), max_length=16, choices=JOB_KINDS)
+    source = models.CharField(_('Source'), max_length=512)
+    target = models.CharField(_('Target'), max_length=512)
+    status = models.CharField(_('Status'), max_length=16, choices=JOB_STATUSES, default=PENDING, db_index=True)
+    attempts = models.PositiveSmallIntegerField(_('Attempts'), default=0)
+    output = models.TextField(_('Output'), blank=True)
+    date_created = models.DateTimeField(_('Created'), auto_now_add=True)
+    date_updated = models.DateTimeField(_('Updated'), auto_now=True)
+
+    class Meta:
+        ordering = ('date_created',)
+
+    def __unicode__(self):
+        return '%s %s' % (self.get_kind_display(), os.path.basename(self.target))
+
+    def get_commands(self):
+        """ The argument lists to run, in order """
+        if self.kind == TRANSCODE:
+            return [[FFMPEG, '-y', '-i', self.source, '-acodec', 'mp3', '-ar', '22050', '-ab', '32',
+                     '-f', 'flv', '-s', '320x240', self.target],
+                    [FLVTOOL2, '-U', self.target]]
+        return [[FFMPEG, '-y', '-i', self.source, '-vframes', '1', '-ss', '00:00:02', '-an',
+                 '-vcodec', 'png', '-f', 'rawvideo', '-s', '320x240', self.target]]
+
+    def finish(self, succeeded, output):
+        """
+            Records the result of a run.  Failed jobs go back in the queue until they have been
+            tried VIDEO_TRANSCODE_RETRIES times, a finished transcode queues the thumbnail.
+        """
+        self.output = output[-VIDEO_TRANSCODE_OUTPUT:]
+        if succeeded:
+            self.status = DONE
+        elif self.attempts < VIDEO_TRANSCODE_RETRIES:
+            self.status = PENDING
+        else:
+            self.status = FAILED
+        self.save()
+        if succeeded and self.kind == TRANSCODE:
+            try:
+                os.unlink(self.source)
+            except OSError:
+                pass
+            TranscodeJob.objects.create(video=self.video, kind=THUMBNAIL, source=self.target,
+                                        target=self.video.thumbfile)
+
 class Gallery(models.Model):
     title = models.CharField(_("Title"), max_length=80)
     date = models.DateField(_("Publication Date"), auto_now_add=True)
@@ -77,6 +169,28 @@ class Gallery(models.Model):
     def get_admin_url(self):
         return '/admin/photogallery/'
 
+    def set_photos(self, photo_ids, removed_ids=()):
+        """
+            Makes photo_ids the photos of this gallery in that order and takes removed_ids out
+            of it, in a fixed number of queries whatever the size of the gallery
+        """
+        photos = Photo.objects.in_bulk(photo_ids)
+        seen = set()
+        ordered = []
+        for photo_id in photo_ids:
+            if photo_id in photos and photo_id not in seen:
+                seen.add(photo_id)
+                ordered.append(photo_id)
+        removed = [photo_id for photo_id in removed_ids if photo_id not in seen]
+
+        PhotoPlace.objects.filter(gallery=self).delete()
+        if removed:
+            Photo.objects.filter(gallery=self, pk__in=removed).update(gallery=None)
+        if ordered:
+            Photo.objects.filter(pk__in=ordered).update(gallery=self)
+            PhotoPlace.objects.insert_places(self, ordered)
+    set_photos = transaction.commit_on_success(set_photos)
+
 class Photo(models.Model):
     image = models.CharField(_("Photograph"), editable=False, max_length=512, blank=True, null=True)
     title = models.CharField(_("Title"), max_length=80, blank=True)
@@ -84,6 +198,8 @@ class Photo(models.Model):
     gallery = models.ForeignKey(Gallery, null=True, blank=True)
     photographer = models.ForeignKey(User, null=True, verbose_name=_("Photographer"), blank=True)
     date = models.DateField(_("Date Photographed"), blank=True, null=True)
+    thumb_width = models.PositiveIntegerField(editable=False, blank=True, null=True)
+    thumb_height = models.PositiveIntegerField(editable=False, blank=True, null=True)
 
     class Meta:
         ordering = ( '-date', )
@@ -135,76 +251,110 @@ class Photo(models.Model):
             pass
         super(Photo, self).delete()
     def save(self):
-        data = ''
-        if self.image != '':
+        if self.image and self.thumb_width is None and not getattr(self, '_rendered', False):
+            self.render()
+        super(Photo, self).save()
+
+    def render(self, digest=None):
+        """
+            Names the photo after the md5sum of its file and writes the display size and the
+            thumbnail, both from a single decode of the upload.  digest is the md5sum when the
+            caller already has it, as the ftp server does
+        """
+        if digest is None:
+            m = md5.new()
             f = open(self.image, 'rb')
-            data = f.read()
-            f.close()
-        m = md5.new()
-        m.update(data)
-        self.image = '%sphotos/%s.jpg' %( settings.MEDIA_ROOT, m.hexdigest() )
-        f = open(self.image, 'wb')
-        f.write(data)
-        f.close()
-        im = Image.open(self.image)
-        format = im.format
-            # Make a copy of the image, scaled, if needed.
-        maxwidth = 640
-        maxheight = 480
-        width, height = im.size
-        newim = im
-        if (width > maxwidth) and width > height:
-            scale = float(maxwidth)/width
-            width = int(width * scale)
-            height = int(height * scale)
             try:
-                newim = im.resize( (width, height), Image.ANTIALIAS )
-            except IOError:
-                pass
-        elif (height > maxheight) and height >= width:
-            scale = float(maxheight)/height
-            width = int(width * scale)
-            height = int(height * scale)
+                chunk = f.read(MD5_CHUNK_SIZE)
+                while chunk:
+                    m.update(chunk)
+                    chunk = f.read(MD5_CHUNK_SIZE)
+            finally:
+                f.close()
+            digest = m.hexdigest()
+        source = self.image
+        self.image = photo_path(digest)
+        outpath = photo_path(digest, 'thumb_')
+        self._rendered = True
+
+        im = Image.open(source)
+        format = im.format
+        size = scaled_size(im.size, DISPLAY_SIZE, False)
+        if size == im.size:
+            if not (os.path.exists(self.image) and os.path.samefile(source, self.image)):
+                shutil.copyfile(source, self.image)
+            newim = im
+        else:
+            # let the JPEG decoder scale down by a power of two before resizing the rest of the way
+            im.draft(im.mode, size)
             try:
-                newim = im.resize( (width, height), Image.ANTIALIAS )
+                newim = im.resize(size, Image.ANTIALIAS)
             except IOError:
-                pass
-        newim.save(self.image, format)
+                newim = im
+            newim.save(self.image, format)
 
-        thumbsize = 165, 125
-        maxwidth = 165
-        maxheight = 125
-        outpath = '%s/photos/thumb_%s.jpg' %( settings.MEDIA_ROOT, m.hexdigest())
         try:
-            im = Image.open(self.image)
-            format = im.format
-            width, height = im.size
-            if (width > maxwidth) and (width > height):
-                scale = float(maxwidth)/width
-                width = int(width * scale)
-                height = int(height * scale)
-                newim = im.resize( (width, height), Image.ANTIALIAS )
-            elif (height > maxheight):
-                scale = float(maxheight)/height
-                width = int(width * scale)
-                height = int(height * scale)
-                newim = im.resize( (width, height), Image.ANTIALIAS )
-            else:
-                newim = im
-                newim.save(outpath, format)
+            thumb = newim.resize(scaled_size(newim.size, THUMB_SIZE, True), Image.ANTIALIAS)
+            thumb.save(outpath, format)
+            self.thumb_width, self.thumb_height = thumb.size
         except IOError:
             print "cannot create thumbnail for", self.image
 
-            super(Photo, self).save()
-
     def thumbdim(self):
-        thumb = os.path.split(self.image)[0] + '/thumb_' + os.path.split(self.image)[1]
-        im = Image.open(thumb)
-        return im.size
+        if self.thumb_width is None:
+            thumb = os.path.split(self.image)[0] + '/thumb_' + os.path.split(self.image)[1]
+            self.thumb_width, self.thumb_height = Image.open(thumb).size
+            Photo.objects.filter(pk=self.pk).update(thumb_width=self.thumb_width, thumb_height=self.thumb_height)
+        return self.thumb_width, self.thumb_height
+
+DISPLAY_SIZE = (640, 480)
+THUMB_SIZE = (165, 125)
+MD5_CHUNK_SIZE = 65536
+
+def photo_path(digest, prefix=''):
+    """ Where the photo with the given md5sum is stored """
+    return os.path.join(settings.MEDIA_ROOT, 'photos', '%s%s.jpg' % (prefix, digest))
+
+def scaled_size(size, maxsize, fit_height):
+    """
+        The size an image is scaled down to.  Wide images are fitted to the width of maxsize and,
+        unless fit_height is set, only the tall ones are fitted to its height
+    """
+    width, height = size
+    maxwidth, maxheight = maxsize
+    if width > maxwidth and width > height:
+        scale = float(maxwidth)/width
+    elif height > maxheight and (fit_height or height >= width):
+        scale = float(maxheight)/height
+    else:
+        return size
+    return max(int(width * scale), 1), max(int(height * scale), 1)
+
+# rows per INSERT, sqlite allows at most 999 parameters in a statement
+PHOTOPLACE_INSERT_ROWS = 300
+
+class PhotoPlaceManager(models.Manager):
+    def insert_places(self, gallery, photo_ids):
+        """ Inserts a place for each photo in photo_ids, numbered from 0, with multi-row INSERTs """
+        qn = connection.ops.quote_name
+        opts = self.model._meta
+        sql = 'INSERT INTO %s (%s, %s, %s) VALUES ' % (qn(opts.db_table),
+            qn(opts.get_field('gallery').column), qn(opts.get_field('photo').column), qn(opts.get_field('place').column))
+        cursor = connection.cursor()
+        for start in range(0, len(photo_ids), PHOTOPLACE_INSERT_ROWS):
+            chunk = photo_ids[start:start + PHOTOPLACE_INSERT_ROWS]
+            params = []
+            for place, photo_id in enumerate(chunk):
+                params.extend((gallery.pk, photo_id, start + place))
+            cursor.execute(sql + ', '.join(['(%s, %s, %s)'] * len(chunk)), params)
+        transaction.set_dirty()
 
 class PhotoPlace(models.Model):
     gallery = models.ForeignKey(Gallery)
     photo = models.ForeignKey(Photo)
     place = models.IntegerField(_('Place'))
+
+    objects = PhotoPlaceManager()
+
     class Meta:
         unique_together = (('gallery', 'photo', 'place'),)
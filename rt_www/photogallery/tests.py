@@ -0,0 +1,31 @@
+from django.conf import settings
+from django.test import TestCase
+
+from rt_www.photogallery.models import Gallery, Photo, PhotoPlace
+
+
+class SetPhotosTest(TestCase):
+    def test_set_photos(self):
+        gallery = Gallery.objects.create(title='set photos')
+        photos = []
+        for title in ('first', 'second', 'third'):
+            # Photo.save takes no arguments, so objects.create can't be used
+            photo = Photo(title=title, gallery=gallery)
+            photo.save()
+            photos.append(photo)
+        first, second, third = photos
+        gallery.set_photos([first.pk, third.pk])
+        # duplicate and unknown ids are dropped
+        gallery.set_photos([third.pk, first.pk, third.pk, 0], [second.pk])
+        places = PhotoPlace.objects.filter(gallery=gallery).order_by('place')
+        self.assertEquals([(p.photo_id, p.place) for p in places],
+                          [(third.pk, 0), (first.pk, 1)])
+        self.assertEquals(Photo.objects.get(pk=second.pk).gallery, None)
+        self.assertEquals(Photo.objects.filter(gallery=gallery).count(), 2)
+
+
+# services and jsonrpclib are not apps, their tests are collected here.
+# The gallery services need photologue.
+from rt_www.jsonrpclib.tests import *
+if 'photologue' in settings.INSTALLED_APPS:
+    from rt_www.services.tests import *
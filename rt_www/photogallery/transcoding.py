@@ -0,0 +1,111 @@
+""" Runs queued video TranscodeJobs.
+
+A single dispatcher claims pending jobs from the database and hands each one
+to a worker thread, never running more than `workers` at a time. Workers only
+run the job's commands; every database write happens in the dispatcher.
+
+"""
+import subprocess
+import threading
+import time
+import Queue
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+
+from photogallery.models import TranscodeJob, PENDING, RUNNING
+
+# Number of jobs run at the same time
+VIDEO_TRANSCODE_WORKERS = getattr(settings, 'VIDEO_TRANSCODE_WORKERS', 2)
+# Seconds between looks at the queue while it is idle
+VIDEO_TRANSCODE_POLL = getattr(settings, 'VIDEO_TRANSCODE_POLL', 5)
+
+
+def run_commands(commands):
+    """ Runs each argument list in turn, stopping at the first failure.
+
+    Returns whether they all succeeded and their combined stdout and stderr.
+    """
+    output = []
+    for args in commands:
+        output.append('$ %s\n' % ' '.join(args))
+        try:
+            proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, close_fds=True)
+        except OSError, e:
+            output.append('%s\n' % e)
+            return False, ''.join(output)
+        output.append(proc.communicate()[0])
+        if proc.returncode != 0:
+            output.append('exited with status %d\n' % proc.returncode)
+            return False, ''.join(output)
+    return True, ''.join(output)
+
+
+def claim(limit):
+    """ Marks up to limit pending jobs as running and returns them.
+
+    Committing here also ends the read snapshot, so jobs queued by the web
+    processes since the last look are seen.
+    """
+    try:
+        jobs = list(TranscodeJob.objects.filter(status=PENDING).select_related('video')[:limit])
+        if jobs:
+            TranscodeJob.objects.filter(pk__in=[job.pk for job in jobs]).update(
+                status=RUNNING, attempts=F('attempts') + 1)
+            for job in jobs:
+                job.status = RUNNING
+                job.attempts += 1
+        transaction.commit()
+    except:
+        transaction.rollback()
+        raise
+    return jobs
+claim = transaction.commit_manually(claim)
+
+
+class TranscodeQueue(object):
+    """ Dispatches queued jobs to a bounded set of worker threads """
+
+    def __init__(self, workers=VIDEO_TRANSCODE_WORKERS, poll=VIDEO_TRANSCODE_POLL):
+        self.workers = max(workers, 1)
+        self.poll = poll
+        self.results = Queue.Queue()
+        self.running = {}
+
+    def _work(self, job, commands):
+        try:
+            succeeded, output = run_commands(commands)
+        except Exception, e:
+            succeeded, output = False, '%s\n' % e
+        self.results.put((job, succeeded, output))
+
+    def start(self, job):
+        self.running[job.pk] = job
+        worker = threading.Thread(target=self._work, args=(job, job.get_commands()))
+        worker.setDaemon(True)
+        worker.start()
+
+    def run(self, once=False, verbosity=1):
+        """ Runs jobs until interrupted, or with once until the queue is empty """
+        # only one dispatcher runs, so running jobs were left by one that died
+        TranscodeJob.objects.filter(status=RUNNING).update(status=PENDING)
+        while True:
+            if len(self.running) < self.workers:
+                for job in claim(self.workers - len(self.running)):
+                    if verbosity:
+                        print 'Starting %s (attempt %d)' % (job, job.attempts)
+                    self.start(job)
+            if not self.running:
+                if once:
+                    return
+                time.sleep(self.poll)
+                continue
+            try:
+                job, succeeded, output = self.results.get(True, self.poll)
+            except Queue.Empty:
+                continue
+            del self.running[job.pk]
+            job.finish(succeeded, output)
+            if verbosity:
+                print '%s: %s' % (job, job.get_status_display())
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+
+"""
+    Times the JSON-RPC middleware against the way it used to work: the per-call overhead of dispatch
+against the getattr based routing used before the route table, and request parsing across payload
+sizes against the regex stripped parse.  Needs DJANGO_SETTINGS_MODULE like the other scripts, the
+service methods called are defined in here so no database is touched.
+
+    usage: jsonrpc_bench.py [ options ] [ dispatch | parse ]
+"""
+import re, time
+from optparse import OptionParser
+
+import simplejson
+
+from rt_www import jsonrpclib
+from rt_www.jsonrpclib.middleware import JSONRPCMiddleware
+
+class Service:
+    def echo(self, arg):
+        return arg
+    def whoami(self, arg, request):
+        return arg
+    whoami.login_required = True
+
+class User:
+    is_staff = False
+    def is_authenticated(self):
+        return True
+
+class Request:
+    method = 'POST'
+    def __init__(self, path, body):
+        self.path, self.raw_post_data, self.user = path, body, User()
+
+class LegacyDispatch:
+    """ The middleware's routing as it was before the route table """
+    def __init__(self, service, type, name):
+        self.modules = ['%s_%s' %( type, name)]
+        for m in dir(service):
+            method = getattr(service, m)
+            if callable(method):
+                self.__dict__['_%s_%s_%s' %(type, name, m)] = method
+
+    def isrpcpath(self, requestpath):
+        root = '_'.join([ p for p in requestpath.split('/') if p != '' ])
+        return root in self.modules
+
+    def getmethod(self, funcpath):
+        try:
+            return getattr(self, '_%s' % funcpath)
+        except AttributeError:
+            return None
+
+    def dispatch(self, request, unmarshaller, args):
+        func = self.getmethod(unmarshaller.getmethodname(request.path))
+        ret_val = { 'version':'1.1', 'id':unmarshaller.get_id() }
+        try:
+            if [ p for p in request.path.split('/') if p != ''][0] == 'adminservices':
+                if not ( request.user.is_authenticated() and request.user.is_staff ):
+                    ret_val['error'] = {'name':'JSONRPCError', 'code':jsonrpclib.FAILURE, 'message':'Permission Denied'}
+            try:
+                lrequired = getattr(func, 'login_required')
+                if lrequired and not request.user.is_authenticated():
+                    ret_val['error'] = {'name':'JSONRPCError', 'code':jsonrpclib.FAILURE, 'message':'Permission Denied'}
+                args = tuple([ a for a in args ] + [ request ])
+            except AttributeError:
+                pass
+            try:
+                isstaff = getattr(func, 'staff_required')
+                if isstaff and not ( request.user.is_authenticated() and request.user.is_staff ):
+                    ret_val['error'] = {'name':'JSONRPCError', 'code':jsonrpclib.FAILURE, 'message':'Permission Denied'}
+                args = tuple([ a for a in args ] + [ request ])
+            except AttributeError:
+                pass
+            ret_val['result'] = func(*args)
+        except Exception, e:
+            ret_val['error'] = {'name':'JSONRPCError', 'code':jsonrpclib.FAILURE, 'message':'%s' % e}
+        return ret_val
+
+    def process_request(self, request):
+        if request.method == 'POST' and self.isrpcpath(request.path):
+            parser, unmarshaller = jsonrpclib.getparser()
+            parser.feed(request.raw_post_data)
+            parser.close()
+            ret_val = self.dispatch(request, unmarshaller, unmarshaller.close())
+            return jsonrpclib.dumps(ret_val)
+
+def best_of(repeat, calls, func):
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        for j in xrange(calls):
+            func()
+        times.append(time.time() - start)
+    return min(times) / calls * 1000000
+
+def bench_dispatch(options):
+    middleware = JSONRPCMiddleware()
+    middleware.register('services', 'bench', Service())
+    legacy = LegacyDispatch(Service(), 'services', 'bench')
+    print '%d routes loaded' % len(middleware.routes)
+
+    for method in ('echo', 'whoami'):
+        request = Request('/services/bench/', jsonrpclib.dumps({'id':1, 'method':method, 'params':['x']}))
+        parser, unmarshaller = jsonrpclib.getparser()
+        parser.feed(request.raw_post_data)
+        parser.close()
+        args = unmarshaller.close()
+        def legacy_dispatch():
+            legacy.isrpcpath(request.path)
+            legacy.dispatch(request, unmarshaller, args)
+        def table_dispatch():
+            middleware.dispatch(request, middleware.resolve_path(request.path), method, args)
+        old = best_of(options.repeat, options.calls, legacy_dispatch)
+        new = best_of(options.repeat, options.calls, table_dispatch)
+        print '%s dispatch: legacy %.2fus, route table %.2fus per call' % (method, old, new)
+        old = best_of(options.repeat, options.calls, lambda: legacy.process_request(request))
+        new = best_of(options.repeat, options.calls, lambda: middleware.process_request(request))
+        print '%s full request: legacy %.2fus, route table %.2fus per call' % (method, old, new)
+
+def legacy_parse(body):
+    """ The unmarshaller's parse before it decoded the body directly """
+    data = re.sub('[\r\n]+', '', ''.join([ body ]))
+    return simplejson.JSONDecoder().decode(data)
+
+def survey_payload(size):
+    """ A survey submission of about size bytes, laid out with newlines like a browser might send it """
+    answer = 'An answer to a survey question, long enough to be typical of the free text ones. ' * 4
+    answers = {}
+    i = 0
+    while len(answers) * (len(answer) + 20) < size:
+        answers['question_%d' % i] = answer
+        i += 1
+    return simplejson.dumps({'id':1, 'method':'submit', 'params':[1, answers]}, indent=1)
+
+def parse(body):
+    parser, unmarshaller = jsonrpclib.getparser()
+    parser.feed(body)
+    parser.close()
+    return unmarshaller.close()
+
+def bench_parse(options):
+    for size in (1024, 16 * 1024, 256 * 1024, 1024 * 1024):
+        body = survey_payload(size)
+        calls = max(options.calls * 1024 / size / 10, 1)
+        old = best_of(options.repeat, calls, lambda: legacy_parse(body))
+        new = best_of(options.repeat, calls, lambda: parse(body))
+        print '%dKB body: regex stripped %.1fus, direct %.1fus per parse' % (len(body) / 1024, old, new)
+
+BENCHMARKS = {
+    'dispatch': bench_dispatch,
+    'parse': bench_parse,
+}
+
+def main():
+    parser = OptionParser()
+    parser.add_option('-n', '--calls', dest='calls', type='int', default=20000,
+        help='Number of calls per timed run')
+    parser.add_option('-r', '--repeat', dest='repeat', type='int', default=5,
+        help='Number of timed runs, the best one is reported')
+    (options, args) = parser.parse_args()
+    for name in args or sorted(BENCHMARKS.keys()):
+        if name not in BENCHMARKS:
+            parser.error('Unknown benchmark "%s". Choose from: %s' % (name, ', '.join(sorted(BENCHMARKS.keys()))))
+        print '== %s ==' % name
+        BENCHMARKS[name](options)
+
+if __name__ == '__main__':
+    main()
@@ -1,17 +1,16 @@
 from zope.interface import implements, Interface
 from twisted.application import internet, service
-from twisted.internet import defer
-from twisted.python import failure
+from twisted.internet import defer, reactor, threads
+from twisted.python import failure, log
 from twisted.cred import portal, checkers, credentials, error as credError
 from twisted.protocols import ftp
 from django.contrib.auth import authenticate, login
 from django.contrib.auth.models import User
-from rt_www.photogallery.models import Photo, Video
+from rt_www.photogallery.models import Photo, Video, photo_path
 from django.conf import settings
 from django.contrib.sessions.models import Session
 
-import tempfile, datetime, os, os.path, md5, Image, re
-import cStringIO as StringIO
+import tempfile, datetime, os, os.path, md5, re
 
 
 """
@@ -25,15 +24,21 @@ import cStringIO as StringIO
     and a list of directories they are allowed to see.  All access is rw for now
 """
 
+""" Photos are saved in the reactor's thread pool so PIL never blocks the event loop """
+PHOTO_THREADS = getattr(settings, 'FTP_PHOTO_THREADS', 4)
+""" Partial uploads are kept out of the photos directory, on the same filesystem so they can be renamed into it """
+UPLOAD_TMP = getattr(settings, 'FTP_UPLOAD_TMP', os.path.join(settings.MEDIA_ROOT, '.ftp_uploads'))
+
 class _PhotoWriter(ftp._FileWriter):
     def __init__(self):
-        self.buffer = StringIO.StringIO()
+        if not os.path.isdir(UPLOAD_TMP):
+            os.makedirs(UPLOAD_TMP)
+        self.tfd, self.fname = tempfile.mkstemp(dir=UPLOAD_TMP, suffix='.part')
         self._receive = False
     def receive(self):
         assert not self._receive, "Can only call IWriteFile.receive *once* per instance"
         self._receive = True
-        # FileConsumer will close the file object
-        return defer.succeed(PhotoConsumer(self.buffer))
+        return defer.succeed(PhotoConsumer(self.tfd, self.fname))
 
 class _VideoWriter(ftp._FileWriter):
     def __init__(self, ext):
@@ -57,24 +62,34 @@ class VideoConsumer(ftp.FileConsumer):
         os.write(self.tfd, bytes)
 
 
+def create_photo(fname, digest):
+    """ Renames the upload to its md5sum and saves the photo, runs in a worker thread """
+    path = photo_path(digest)
+    try:
+        os.rename(fname, path)
+        photo = Photo(image=path)
+        photo.render(digest)
+        photo.save()
+    except:
+        if os.path.exists(fname):
+            os.unlink(fname)
+        elif os.path.exists(path) and not Photo.objects.filter(image=path).count():
+            os.unlink(path)
+        raise
+
 class PhotoConsumer(ftp.FileConsumer):
-    def __init__(self, buffer):
-        self.buffer = buffer
+    """ Streams the upload to disk, computing its md5sum on the way """
+    def __init__(self, fd, fname):
+        self.tfd, self.fname = fd, fname
+        self.md5 = md5.new()
     def unregisterProducer(self):
         self.producer = None
-        #Now we save the file after renaming it to the md5sum
-        tfd, fname = tempfile.mkstemp(dir='%s/tmp' % settings.ROOT)
-        os.write(tfd, self.buffer.getvalue())
-        self.buffer.close()
-        os.close(tfd)
-    p = Photo(image=fname)
-        p.save()
-        try:
-            os.unlink(fname)
-        except:
-            pass
+        os.close(self.tfd)
+        d = threads.deferToThread(create_photo, self.fname, self.md5.hexdigest())
+        d.addErrback(log.err)
     def write(self, bytes):
-        self.buffer.write(bytes)
+        os.write(self.tfd, bytes)
+        self.md5.update(bytes)
 
 class RTFTPShell(ftp.FTPShell):
     allowed_dirs = ['pdfs', 'uploads', 'photos', 'videos', 'flash', 'backups' ]
@@ -319,6 +334,7 @@ class RedtideFTPFactory(ftp.FTPFactory):
 
 def main():
     app = service.Application('Redtide FTP Server')
+    reactor.suggestThreadPoolSize(PHOTO_THREADS)
 
     p = portal.Portal(RedtideFTPRealm(settings.MEDIA_ROOT))
     p.registerChecker(RedtideUPAuthenticator())
@@ -1,40 +1,61 @@
-from photologue.models import Photo, Gallery
+from django.db import connection
+from django.db.models import Count
+from photologue.models import Photo, Gallery, CachedSize, PhotoSizeCache
 # from rt_www.photogallery.models import Photo, Gallery, PhotoPlace
 
+def get_covers(galleries):
+    """
+        The latest public photo of each of galleries, keyed by gallery id, in two queries.
+        Of photos added at the same time the last one created is the cover.
+    """
+    if not galleries:
+        return {}
+    field = Gallery._meta.get_field('photos')
+    qn = connection.ops.quote_name
+    # the cover of each gallery is picked by a subquery on its own row
+    cover = ('SELECT p.%(pk)s FROM %(photo)s p INNER JOIN %(m2m)s m ON m.%(photo_id)s = p.%(pk)s'
+             ' WHERE m.%(gallery_id)s = %(gallery)s.%(gallery_pk)s AND p.%(public)s = %%s'
+             ' ORDER BY p.%(date)s DESC, p.%(pk)s DESC LIMIT 1') % {
+        'pk': qn(Photo._meta.pk.column), 'photo': qn(Photo._meta.db_table),
+        'm2m': qn(field.m2m_db_table()), 'photo_id': qn(field.m2m_reverse_name()),
+        'gallery_id': qn(field.m2m_column_name()), 'gallery': qn(Gallery._meta.db_table),
+        'gallery_pk': qn(Gallery._meta.pk.column), 'public': qn(Photo._meta.get_field('is_public').column),
+        'date': qn(Photo._meta.get_field('date_added').column)}
+    cover_ids = dict(Gallery.objects.filter(pk__in=[g.id for g in galleries])
+                     .extra(select={'cover_id': cover}, select_params=(True,))
+                     .values_list('id', 'cover_id'))
+    photos = Photo.objects.in_bulk([pk for pk in cover_ids.values() if pk is not None])
+    return dict([(gid, photos[pk]) for gid, pk in cover_ids.items() if pk in photos])
+
 class Service:
     def get_thumb(self, pid):
         return Photo.objects.get(pk=pid).get_thumb()
     def gallery_view(self, offset, limit):
-        ret_val, offset, limit = {'count':Gallery.objects.count(), 'list':[]}, int(offset), int(limit)
-        gallerys = Gallery.objects.all().order_by('-date_added')
-        start, stop = offset, offset+limit
-        if ret_val['count'] < stop:
-            stop = ret_val['count']
-        ret_val['list'] = [ { 'gid':g.id, 'thumburl':g.public()[0].get_thumbnail_url(),
-                # 'ratio':'%0.2lf' %(float(g.photos().all()[0].thumbdim()[0])/float(g.photos().all()[0].thumbdim()[1])),
-                'title':g.title, 'fullurl':g.public()[0].get_display_url()
-                }
-                for g in gallerys if g.photo_count(True) > 0 ]
-        if stop < len(ret_val['list']):
-            ret_val['list'] = ret_val['list'][start:stop]
-        else:
-            ret_val['list'] = ret_val['list'][start:]
-        return ret_val
-        
-    def gallery_details(self, offset, limit):
-        ret_val, offset, limit, count = {}, int(offset), int(limit), Gallery.objects.count()
-        gallerys = Gallery.objects.all()
-        start, stop = offset, offset+limit
-        if count < stop:
-            stop = count
-
-        for g in gallerys[start:stop]:
-            try:
-                # ordering = PhotoPlace.objects.filter(gallery__id__exact=g.id).order_by('place')
-                # ordering = Photo.objects.filter(public_galleries__id__exact=g.id)
-                ret_val[str(g.id)] = [ { 'url': photo.get_display_url(), 'title': photo.title } for photo in g.public() ]
-            except Photo.DoesNotExist:
+        """ A page of the galleries that have public photos, each with its latest public photo as cover """
+        offset, limit = int(offset), int(limit)
+        galleries = Gallery.objects.filter(photos__is_public=True)
+        ret_val = {'count':galleries.distinct().count(), 'list':[]}
+        page = list(galleries.annotate(public_count=Count('photos')).order_by('-date_added')[offset:offset+limit])
+        covers = get_covers(page)
+        CachedSize.objects.prefetch(covers.values())
+        sizes = PhotoSizeCache().sizes
+        thumbnail, display = sizes['thumbnail'], sizes['display']
+        for g in page:
+            cover = covers.get(g.id)
+            if cover is None:
                 continue
+            # listing galleries doesn't count as viewing their covers
+            ret_val['list'].append({ 'gid':g.id, 'thumburl':cover._get_url_for_size(thumbnail),
+                'title':g.title, 'fullurl':cover._get_url_for_size(display), 'count':g.public_count })
         return ret_val
+    gallery_view.concurrent_safe = True
+
+    def gallery_details(self, offset, limit):
+        """ The public photos of the galleries on a gallery_view page, keyed by gallery id """
+        offset, limit = int(offset), int(limit)
+        gallery_ids = list(Gallery.objects.filter(photos__is_public=True).distinct()
+                           .order_by('-date_added').values_list('id', flat=True)[offset:offset+limit])
+        return dict([(str(gid), photos) for gid, photos in Gallery.objects.photo_lists(gallery_ids, 'display').items()])
+    gallery_details.concurrent_safe = True
 
 service = Service()
@@ -14,6 +14,7 @@ class Service:
         q = Question.objects.get(pk=qid)
         qobj = q.get_question_object()
         return {'id':q.id, 'type':qobj.create_choice_widget()['type'], 'data':qobj.render(), 'question':q.question }
+    get_question.concurrent_safe = True
 
     def get_questions(self, sid):
         """
@@ -27,6 +28,7 @@ class Service:
         return { 'introduction':survey.introduction,
                  'data':[ { 'id':q.id, 'type':q.get_question_object().create_choice_widget()['type'],
                      'question':q.question, 'data':q.get_question_object().render() } for q in questions ] }
+    get_questions.concurrent_safe = True
 
     def save_answers(self, answers, survey_id, uid = -1):
         uid = int(uid)
@@ -0,0 +1,78 @@
+"""
+    Tests for the JSON-RPC services.  services is not an installed app, these run with the
+    photogallery tests when photologue is installed.
+"""
+import os
+from datetime import datetime
+
+import photologue
+from django.core.files.base import ContentFile
+from django.test import TestCase
+from photologue.counters import ViewCounter
+from photologue.models import Gallery, Photo, PhotoSize
+from rt_www.services.photogallery import service as gallery_service
+
+RES_DIR = os.path.join(os.path.dirname(photologue.__file__), 'res')
+LANDSCAPE_IMAGE_PATH = os.path.join(RES_DIR, 'test_landscape.jpg')
+PORTRAIT_IMAGE_PATH = os.path.join(RES_DIR, 'test_portrait.jpg')
+SQUARE_IMAGE_PATH = os.path.join(RES_DIR, 'test_square.jpg')
+
+
+class GalleryViewTest(TestCase):
+    def setUp(self):
+        self.thumbnail = PhotoSize.objects.create(name='thumbnail', width=50, height=50,
+                                                  increment_count=True)
+        self.display = PhotoSize.objects.create(name='display', width=100, height=100)
+        self.photos = []
+        self.old = Gallery.objects.create(title='view old', title_slug='view-old',
+                                          date_added=datetime(2009, 1, 1))
+        self.new = Gallery.objects.create(title='view new', title_slug='view-new',
+                                          date_added=datetime(2009, 2, 1))
+        self.private = Gallery.objects.create(title='view private', title_slug='view-private',
+                                              date_added=datetime(2009, 3, 1))
+        self.old.photos.add(self.make_photo('view-1', LANDSCAPE_IMAGE_PATH, 2, True),
+                            self.make_photo('view-2', PORTRAIT_IMAGE_PATH, 3, True))
+        self.new.photos.add(self.make_photo('view-3', SQUARE_IMAGE_PATH, 4, True),
+                            self.make_photo('view-4', LANDSCAPE_IMAGE_PATH, 5, False))
+        self.private.photos.add(self.make_photo('view-5', PORTRAIT_IMAGE_PATH, 6, False))
+
+    def tearDown(self):
+        for gallery in (self.old, self.new, self.private):
+            gallery.delete()
+        for photo in self.photos:
+            photo.delete()
+        self.thumbnail.delete()
+        self.display.delete()
+
+    def make_photo(self, slug, path, day, is_public):
+        photo = Photo(title=slug, title_slug=slug, is_public=is_public,
+                      date_added=datetime(2009, 1, day))
+        photo.image.save(os.path.basename(path), ContentFile(open(path, 'rb').read()))
+        photo.save()
+        self.photos.append(photo)
+        return photo
+
+    def test_gallery_view(self):
+        result = gallery_service.gallery_view(0, 10)
+        self.assertEquals(result['count'], 2)
+        self.assertEquals([(g['gid'], g['title'], g['count']) for g in result['list']],
+                          [(self.new.pk, 'view new', 1), (self.old.pk, 'view old', 2)])
+        # the cover is the latest public photo
+        covers = [self.photos[2], self.photos[1]]
+        self.assertEquals([(g['thumburl'], g['fullurl']) for g in result['list']],
+                          [(p._get_url_for_size(self.thumbnail), p._get_url_for_size(self.display))
+                           for p in covers])
+        # listing the galleries doesn't count views
+        ViewCounter().flush()
+        self.assertEquals([p.view_count for p in Photo.objects.filter(pk__in=[c.pk for c in covers])], [0, 0])
+
+    def test_cover_tie(self):
+        # added at the same time as the current cover, but created later
+        self.old.photos.add(self.make_photo('view-6', SQUARE_IMAGE_PATH, 3, True))
+        result = gallery_service.gallery_view(1, 1)
+        self.assertEquals(result['list'][0]['fullurl'], self.photos[-1]._get_url_for_size(self.display))
+
+    def test_pagination(self):
+        result = gallery_service.gallery_view(1, 1)
+        self.assertEquals(result['count'], 2)
+        self.assertEquals([g['gid'] for g in result['list']], [self.old.pk])
@@ -29,6 +29,12 @@ else:
 DATABASE_ENGINE = 'sqlite3' # 'postgresql', 'mysql', 'sqlite3' or 'ado_mssql'.
 DATABASE_NAME = '%s/rt.db' % thePath            # Or path to database file if using sqlite3.
 ROOT = '%s/rt_www' % thePath
+
+# Photologue shares its photo size generation, view count flush requests, zip upload progress
+# and gallery photo lists between processes through the cache, so it needs a backend every
+# process sees: memcached, or the database cache after "manage.py createcachetable cache_table".
+# The default per-process locmem cache only works for a single process.
+CACHE_BACKEND = 'db://cache_table'
 SVNREPOS = '/home/svn/redtide'
 
 # Local time zone for this installation. All choices can be found here:
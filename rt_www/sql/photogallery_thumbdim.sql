@@ -0,0 +1,4 @@
+BEGIN;
+ALTER TABLE "photogallery_photo" ADD COLUMN "thumb_width" integer unsigned NULL;
+ALTER TABLE "photogallery_photo" ADD COLUMN "thumb_height" integer unsigned NULL;
+COMMIT;